@@ -0,0 +1,200 @@
+"""
+Moves expired offers out of the hot ``product`` table.
+
+Listings, facets and search only read ``product``; expired offers are moved
+to ``product_archive`` (``ArchivedProduct``) in bounded batches by a
+background sweeper, so the hot table stays the size of the live catalog.
+Archived offers keep their page (GET /product/{id}) and their owner can still
+edit or delete them; extending the offer moves the row back to ``product``
+(``restore_product``).
+"""
+
+import asyncio
+import logging
+import time
+from datetime import date
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, status
+from tortoise import timezone
+from tortoise.exceptions import IntegrityError
+from tortoise.transactions import in_transaction
+
+from catalog import response_cache
+from feed import change_feed
+from models import ArchivedProduct, Product
+from settings import settings
+from writes import (
+    NOT_OWNER,
+    columns,
+    product_conditions,
+    product_write_refused,
+    update_owned_product,
+)
+
+logger = logging.getLogger(__name__)
+
+# seconds between sweeps and rows moved per transaction
+ARCHIVE_INTERVAL = settings.ARCHIVE_INTERVAL
+ARCHIVE_BATCH_SIZE = settings.ARCHIVE_BATCH_SIZE
+
+
+def _archive_sql() -> str:
+    # the batch is chosen by the INSERT itself, so the sweep holds the write
+    # lock from its first statement: sweepers in other workers wait for it and
+    # then take the next batch rather than the same rows
+    names = columns(Product)
+    return (
+        f'INSERT INTO "product_archive" ({names}, "archived_at") '
+        f'SELECT {names}, ? FROM "product" WHERE "offer_expiriation_date" < ? '
+        'ORDER BY "offer_expiriation_date" LIMIT ? RETURNING "id", "business_id"'
+    )
+
+
+async def restore_product(
+    product_id: int,
+    owner_id: int,
+    values: Dict[str, Any],
+    if_match: Optional[str] = None,
+    detail: str = NOT_OWNER,
+) -> Product:
+    """
+    Moves an archived offer of ``owner_id`` back to ``product`` and writes
+    ``values`` to it (``update_owned_product``), in one transaction. Meant
+    for values that extend the offer; one still expired is archived again by
+    the next sweep.
+
+    Raises:
+        DoesNotExist: If there is no archived product with this id.
+        HTTPException: 401 for products of other owners, 412 when
+            ``if_match`` does not match its ETag, 409 when a live product
+            uses the name it goes back under.
+    """
+    names = columns(Product)
+    # a renamed offer goes back under its new name, so only that name can
+    # clash with a live product
+    renamed = [values["name"]] if "name" in values else []
+    selected = ", ".join(
+        "?" if field == "name" and renamed else f'"{column}"'
+        for field, column in Product._meta.fields_db_projection.items()
+    )
+    _, condition, versions = product_conditions(ArchivedProduct, if_match)
+    # update_owned_product writes through connections.get("default"), which
+    # is this transaction until the block ends
+    async with in_transaction("default") as connection:
+        try:
+            _, rows = await connection.execute_query(
+                f'INSERT INTO "product" ({names}) SELECT {selected} FROM "product_archive" '
+                f'WHERE "id" = ? AND {condition} RETURNING "id"',
+                [*renamed, product_id, owner_id, *versions],
+            )
+        except IntegrityError:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="A live product already uses this name.",
+            )
+        if not rows:
+            await product_write_refused(product_id, owner_id, detail, ArchivedProduct)
+        await connection.execute_query(
+            'DELETE FROM "product_archive" WHERE "id" = ?', [product_id]
+        )
+        return await update_owned_product(product_id, owner_id, values, if_match, detail)
+
+
+class OfferSweeper:
+    """
+    Background task that archives products whose offer has expired, one
+    batch per transaction so writers are never blocked for long.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Dict[str, float] = {"moved": 0, "batches": 0, "seconds": 0.0}
+        self.total_moved = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Archiving expired offers failed")
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    async def sweep(self, today: Optional[date] = None) -> Dict[str, float]:
+        """
+        Archives every product whose offer expired before ``today``.
+
+        Returns:
+            dict: Rows moved, batches used and seconds taken by this run.
+        """
+        today = today or date.today()
+        start = time.perf_counter()
+        moved = batches = 0
+        while count := await self._archive_batch(today):
+            moved += count
+            batches += 1
+            # let requests run between batches
+            await asyncio.sleep(0)
+        self.last_run = {
+            "moved": moved,
+            "batches": batches,
+            "seconds": round(time.perf_counter() - start, 6),
+        }
+        self.total_moved += moved
+        if moved:
+            logger.info(
+                "Archived %d expired offers in %d batches (%.3fs)",
+                moved,
+                batches,
+                self.last_run["seconds"],
+            )
+        return self.last_run
+
+    async def _archive_batch(self, today: date) -> int:
+        async with in_transaction("default") as connection:
+            _, rows = await connection.execute_query(
+                _archive_sql(),
+                [timezone.now().isoformat(" "), today.isoformat(), ARCHIVE_BATCH_SIZE],
+            )
+            if not rows:
+                return 0
+            rows = [(row["id"], row["business_id"]) for row in rows]
+            ids = [product_id for product_id, _ in rows]
+            placeholders = ", ".join("?" * len(ids))
+            await connection.execute_query(
+                f'DELETE FROM "product" WHERE "id" IN ({placeholders})', ids
+            )
+        await response_cache.invalidate(
+            "products",
+            *(f"product:{product_id}" for product_id in ids),
+            *{f"storefront:{business_id}" for _, business_id in rows},
+        )
+        await change_feed.publish_many(
+            "product.archived",
+            [{"id": product_id, "business_id": business_id} for product_id, business_id in rows],
+        )
+        return len(ids)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "last_moved": self.last_run["moved"],
+            "last_batches": self.last_run["batches"],
+            "last_seconds": self.last_run["seconds"],
+            "total_moved": self.total_moved,
+        }
+
+
+offer_sweeper = OfferSweeper()
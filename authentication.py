@@ -1,19 +1,100 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
 from passlib.context import CryptContext
 import jwt
-from dotenv import dotenv_values
 from models import User
 from fastapi import HTTPException
+from cache import TTLCache
+from settings import settings
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-from dotenv import dotenv_values
 
 
-config_crdentials = dotenv_values(".env")
+# decoded tokens (token -> user id) and user rows (user id -> User) for get_current_user
+token_cache = TTLCache(
+    maxsize=settings.TOKEN_CACHE_SIZE,
+    ttl=settings.USER_CACHE_TTL,
+)
+user_cache = TTLCache(
+    maxsize=settings.USER_CACHE_SIZE,
+    ttl=settings.USER_CACHE_TTL,
+)
+
+
+# bcrypt worker pool: "thread", "process" or "inline" (run on the event loop)
+hash_pool_kind = "inline"
+hash_pool_workers = 0
+hash_queue_depth = 0
+_hash_executor: Optional[Executor] = None
+_hash_jobs = 0  # jobs queued or running in the pool
+
+
+def configure_hash_pool(kind: str = "thread", workers: int = 2, queue_depth: int = 32):
+    """
+    (Re)creates the pool used for bcrypt hashing and verification.
+
+    Args:
+        kind (str): "thread", "process" or "inline".
+        workers (int): Number of hashes computed concurrently.
+        queue_depth (int): Jobs allowed to wait for a worker before requests get a 503.
+    """
+    global hash_pool_kind, hash_pool_workers, hash_queue_depth, _hash_executor
+    if kind not in ("thread", "process", "inline"):
+        raise ValueError(f"Unknown hash pool kind: {kind}")
+    if _hash_executor is not None:
+        _hash_executor.shutdown(wait=False)
+    hash_pool_kind, hash_pool_workers, hash_queue_depth = kind, workers, queue_depth
+    if kind == "process":
+        _hash_executor = ProcessPoolExecutor(max_workers=workers)
+    elif kind == "thread":
+        _hash_executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt"
+        )
+    else:
+        _hash_executor = None
+
+
+configure_hash_pool(settings.HASH_POOL, settings.HASH_WORKERS, settings.HASH_QUEUE_DEPTH)
+
+
+# module level so they can be pickled for the process pool
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(password: str, hashed: str) -> bool:
+    return pwd_context.verify(password, hashed)
+
+
+async def run_in_hash_pool(func: Callable, *args):
+    """
+    Runs a bcrypt call in the hash pool.
+
+    Raises:
+        HTTPException: 503 when every worker is busy and the wait queue is full.
+    """
+    global _hash_jobs
+    if _hash_executor is None:
+        return func(*args)
+    if _hash_jobs >= hash_pool_workers + hash_queue_depth:
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please try again later.",
+            headers={"Retry-After": "1"},
+        )
+    _hash_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_executor, func, *args)
+    finally:
+        _hash_jobs -= 1
 
 
 async def get_hash_password(password: str):
     """
-    Hashes a password using bcrypt.
+    Hashes a password using bcrypt, off the event loop.
 
     Args:
         password (str): The password to hash.
@@ -21,12 +102,12 @@ async def get_hash_password(password: str):
     Returns:
         str: The hashed password.
     """
-    return pwd_context.hash(password)
+    return await run_in_hash_pool(_hash, password)
 
 
 async def verify_token(token: str):
     try:
-        payload = jwt.decode(token, config_crdentials["SECRET"], algorithms=["HS256"])
+        payload = jwt.decode(token, settings.SECRET, algorithms=["HS256"])
         user_id = payload["id"]
         user = await User.get(id=user_id)
         await user.save()
@@ -43,7 +124,7 @@ async def authenticate_user(username: str, password: str):
     user = await User.get(username=username)
     if not user:
         return False
-    if not pwd_context.verify(password, user.password):
+    if not await run_in_hash_pool(_verify, password, user.password):
         return False
     return user
 
@@ -62,4 +143,4 @@ async def token_generator(username: str, password: str):
         "username": username,
         # "password": password,
     }
-    return jwt.encode(token_payload, config_crdentials["SECRET"], algorithm="HS256")
+    return jwt.encode(token_payload, settings.SECRET, algorithm="HS256")
@@ -0,0 +1,111 @@
+"""
+Throughput of /registration and /token with bcrypt on the event loop
+("inline", the old behaviour) versus the thread and process hash pools.
+
+While the requests run, a probe hits ``/`` every 10ms and records how late
+each round trip finishes; its worst lag shows how long the event loop was
+blocked.
+
+    python benchmarks/bench_auth.py --workers 2 --requests 40 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import time
+
+from common import client, load_app, percentile, sandbox, timer
+
+
+async def probe(c, stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        await c.get("/")
+        samples.append(time.perf_counter() - start - 0.01)
+
+
+async def drive(c, requests: int, concurrency: int, make_request):
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = []
+
+    async def one(i):
+        async with semaphore:
+            response = await make_request(i)
+            statuses.append(response.status_code)
+
+    with timer() as t:
+        await asyncio.gather(*(one(i) for i in range(requests)))
+    return t["elapsed"], statuses
+
+
+async def run_mode(c, mode: str, args):
+    import authentication
+
+    authentication.configure_hash_pool(mode, args.workers, args.queue_depth)
+    results = {}
+    for endpoint in ("/registration", "/token"):
+        if endpoint == "/registration":
+
+            def make_request(i):
+                name = f"{mode}{i}"
+                return c.post(
+                    "/registration",
+                    json={
+                        "username": name,
+                        "email": f"{name}@example.com",
+                        "password": "benchmark",
+                    },
+                )
+
+        else:
+
+            def make_request(i):
+                return c.post(
+                    "/token",
+                    data={"username": f"{mode}{i}", "password": "benchmark"},
+                )
+
+        stop, samples = asyncio.Event(), []
+        probe_task = asyncio.create_task(probe(c, stop, samples))
+        elapsed, statuses = await drive(c, args.requests, args.concurrency, make_request)
+        stop.set()
+        await probe_task
+        results[endpoint] = {
+            "req_per_s": args.requests / elapsed,
+            "rejected": statuses.count(503),
+            "lag_p50_ms": percentile(samples, 50) * 1000,
+            "lag_max_ms": max(samples, default=0) * 1000,
+        }
+    return results
+
+
+async def main(args):
+    app = load_app()
+    await app.router.startup()
+    try:
+        async with client(app) as c:
+            print(
+                f"{'mode':<8} {'endpoint':<14} {'req/s':>8} {'503s':>5} "
+                f"{'lag p50 ms':>13} {'lag max ms':>13}"
+            )
+            for mode in args.modes:
+                for endpoint, r in (await run_mode(c, mode, args)).items():
+                    print(
+                        f"{mode:<8} {endpoint:<14} {r['req_per_s']:>8.1f} "
+                        f"{r['rejected']:>5} {r['lag_p50_ms']:>13.1f} "
+                        f"{r['lag_max_ms']:>13.1f}"
+                    )
+    finally:
+        await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=["inline", "thread", "process"])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queue-depth", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    sandbox()
+    asyncio.run(main(args))
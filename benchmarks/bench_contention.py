@@ -0,0 +1,136 @@
+"""
+Product writes under contention: concurrent writers raising the price of a few
+hot products by one, with
+
+* ``load-save``: the old path, load the product with its business and owner,
+  check the owner, save the whole row (lost updates are possible);
+* ``if-match``: read the versions, then one conditional UPDATE with If-Match,
+  retrying on 412;
+* ``blind``: one conditional UPDATE without If-Match (no read at all).
+
+Reports writes per second, latency, the share of attempts refused with 412
+and the increments lost to overwrites. Each run uses its own sandbox database.
+
+    python benchmarks/bench_contention.py --writers 1 8 32 --hot 1 10
+"""
+
+import argparse
+import asyncio
+import time
+from decimal import Decimal
+
+from common import load_app, percentile, sandbox, seed
+
+BASE_PRICE = Decimal(1000)
+
+
+async def load_save(product_id: int, owner_id: int):
+    from catalog import get_product_with_business
+
+    product = await get_product_with_business(product_id)
+    if product.business.owner.id != owner_id:
+        raise RuntimeError("not the owner")
+    product.new_price += 1
+    await product.save()
+    return 0
+
+
+async def if_match(product_id: int, owner_id: int):
+    from fastapi import HTTPException
+    from models import Product
+    from writes import update_owned_product
+
+    conflicts = 0
+    while True:
+        product = await Product.filter(id=product_id).select_related("business").get()
+        etag = f'"{product.version}.{product.business.version}"'
+        try:
+            await update_owned_product(
+                product_id, owner_id, {"new_price": product.new_price + 1}, etag
+            )
+            return conflicts
+        except HTTPException as exc:
+            if exc.status_code != 412:
+                raise
+            conflicts += 1
+
+
+async def blind(product_id: int, owner_id: int):
+    from writes import update_owned_product
+
+    await update_owned_product(product_id, owner_id, {"new_price": BASE_PRICE + 1})
+    return 0
+
+
+MODES = {"load-save": load_save, "if-match": if_match, "blind": blind}
+
+
+async def run_mode(write, writers: int, hot: int, duration: float, owners: dict):
+    from models import Product
+
+    await Product.filter(id__in=list(owners)).update(new_price=BASE_PRICE)
+    latencies, conflicts, done = [], [0], {product_id: 0 for product_id in owners}
+    deadline = time.perf_counter() + duration
+
+    async def worker(n):
+        i = n
+        while time.perf_counter() < deadline:
+            product_id = i % hot + 1
+            i += writers
+            start = time.perf_counter()
+            conflicts[0] += await write(product_id, owners[product_id])
+            latencies.append(time.perf_counter() - start)
+            done[product_id] += 1
+
+    await asyncio.gather(*(worker(n) for n in range(writers)))
+    prices = dict(await Product.filter(id__in=list(owners)).values_list("id", "new_price"))
+    lost = sum(done[i] - int(prices[i] - BASE_PRICE) for i in owners)
+    return latencies, conflicts[0], lost
+
+
+async def main(args):
+    app = load_app()
+    await app.router.startup()
+    try:
+        from models import Product
+
+        await seed(products=max(args.hot), businesses=max(args.hot))
+        owners = {
+            product_id: owner_id
+            for product_id, owner_id in await Product.filter(id__lte=max(args.hot))
+            .values_list("id", "business__owner_id")
+        }
+        print(
+            f"{'mode':>9} {'hot':>4} {'writers':>7} {'writes/s':>9} {'p50 ms':>8} "
+            f"{'p99 ms':>8} {'412 %':>6} {'lost':>6}"
+        )
+        for hot in args.hot:
+            hot_owners = {i: owners[i] for i in range(1, hot + 1)}
+            for writers in args.writers:
+                for mode in args.modes:
+                    latencies, conflicts, lost = await run_mode(
+                        MODES[mode], writers, hot, args.duration, hot_owners
+                    )
+                    attempts = len(latencies) + conflicts
+                    # blind writes set the price instead of raising it
+                    lost = "-" if mode == "blind" else lost
+                    print(
+                        f"{mode:>9} {hot:>4} {writers:>7} "
+                        f"{len(latencies) / args.duration:>9.1f} "
+                        f"{percentile(latencies, 50) * 1000:>8.2f} "
+                        f"{percentile(latencies, 99) * 1000:>8.2f} "
+                        f"{conflicts / max(attempts, 1) * 100:>6.1f} {lost:>6}"
+                    )
+    finally:
+        await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--hot", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--duration", type=float, default=3)
+    args = parser.parse_args()
+    sandbox()
+    asyncio.run(main(args))
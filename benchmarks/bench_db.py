@@ -0,0 +1,111 @@
+"""
+Catalog read throughput at increasing client concurrency while a writer keeps
+updating products, with a single shared connection (--readers 0) versus the
+reader connection pool.
+
+Each setting runs in its own process and sandbox. The response cache is
+disabled so every read reaches the database.
+
+    python benchmarks/bench_db.py --readers 0 4 --concurrency 1 4 16
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+from common import client, load_app, percentile, sandbox, seed
+
+
+async def writer(stop: asyncio.Event, products: int, counter: list):
+    from models import Product
+
+    i = 0
+    while not stop.is_set():
+        i += 1
+        await Product.filter(id=i % products + 1).update(new_price=str(i % 500 + 1))
+        counter[0] += 1
+        await asyncio.sleep(0)
+
+
+async def readers(c, concurrency: int, duration: float, products: int):
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def reader(n):
+        i = n
+        while time.perf_counter() < deadline:
+            i += concurrency
+            start = time.perf_counter()
+            if i % 2:
+                await c.get("/product", params={"category": "tech", "limit": 20})
+            else:
+                await c.get(f"/product/{i % products + 1}")
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(reader(n) for n in range(concurrency)))
+    return latencies
+
+
+async def run(args):
+    import catalog
+
+    catalog.response_cache.max_bytes = 0
+    app = load_app()
+    await app.router.startup()
+    results = []
+    try:
+        await seed(products=args.products, businesses=max(1, args.products // 100))
+        async with client(app) as c:
+            for concurrency in args.concurrency:
+                stop, writes = asyncio.Event(), [0]
+                write_task = asyncio.create_task(writer(stop, args.products, writes))
+                latencies = await readers(c, concurrency, args.duration, args.products)
+                stop.set()
+                await write_task
+                results.append(
+                    {
+                        "concurrency": concurrency,
+                        "reads_per_s": len(latencies) / args.duration,
+                        "writes_per_s": writes[0] / args.duration,
+                        "p50_ms": percentile(latencies, 50) * 1000,
+                        "p99_ms": percentile(latencies, 99) * 1000,
+                    }
+                )
+    finally:
+        await app.router.shutdown()
+    print(json.dumps(results))
+
+
+def main(args):
+    print(
+        f"{'readers':>7} {'clients':>7} {'reads/s':>9} {'writes/s':>9} "
+        f"{'p50 ms':>8} {'p99 ms':>8}"
+    )
+    for readers_count in args.readers:
+        command = [sys.executable, __file__, "--child", str(readers_count)]
+        command += ["--products", str(args.products), "--duration", str(args.duration)]
+        command += ["--concurrency", *map(str, args.concurrency)]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        for r in json.loads(output.strip().splitlines()[-1]):
+            print(
+                f"{readers_count:>7} {r['concurrency']:>7} {r['reads_per_s']:>9.1f} "
+                f"{r['writes_per_s']:>9.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--readers", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is None:
+        main(args)
+    else:
+        sandbox(env={"DB_READERS": args.child})
+        asyncio.run(run(args))
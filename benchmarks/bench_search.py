@@ -0,0 +1,73 @@
+"""
+Product search: FTS5 (bm25 ranked, first page) versus LIKE scans over name,
+category and description, on a seeded catalog.
+
+    python benchmarks/bench_search.py --products 100000
+"""
+
+import argparse
+import asyncio
+import time
+
+from common import load_app, percentile, sandbox, seed
+
+QUERIES = ["shoe", "leather jacket", "wireless", "pro camera", "kettle", "zzz"]
+
+LIKE_WHERE = "name LIKE ? OR category LIKE ? OR product_description LIKE ?"
+# first page in table order: stops early on common words, but cannot rank
+LIKE_PAGE = f'SELECT id FROM "product" WHERE {LIKE_WHERE} LIMIT ?'
+# what any ranking on top of LIKE needs: every matching row
+LIKE_SCAN = f'SELECT count(*) FROM "product" WHERE {LIKE_WHERE}'
+
+
+async def timed(func, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def main(args):
+    app = load_app()
+    await app.router.startup()
+    try:
+        from tortoise import connections
+        from search import search_products
+
+        start = time.perf_counter()
+        await seed(products=args.products, businesses=max(1, args.products // 1000))
+        print(f"seeded {args.products} products in {time.perf_counter() - start:.1f}s")
+        db = connections.get("default")
+
+        print(
+            f"{'query':<16} {'fts p50 ms':>11} {'fts p95 ms':>11} "
+            f"{'like page p50':>14} {'like scan p50':>14}"
+        )
+        for q in QUERIES:
+            fts = await timed(lambda: search_products(q, args.limit), args.repeat)
+            pattern = [f"%{q.split()[0]}%"] * 3
+            like_page = await timed(
+                lambda: db.execute_query(LIKE_PAGE, pattern + [args.limit + 1]),
+                args.repeat,
+            )
+            like_scan = await timed(lambda: db.execute_query(LIKE_SCAN, pattern), args.repeat)
+            print(
+                f"{q:<16} {percentile(fts, 50) * 1000:>11.2f} "
+                f"{percentile(fts, 95) * 1000:>11.2f} "
+                f"{percentile(like_page, 50) * 1000:>14.2f} "
+                f"{percentile(like_scan, 50) * 1000:>14.2f}"
+            )
+    finally:
+        await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    sandbox()
+    asyncio.run(main(args))
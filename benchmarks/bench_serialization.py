@@ -0,0 +1,81 @@
+"""
+Product listing serialization: pydantic models encoded by FastAPI's JSON
+response (the old path) versus ``.values()`` rows encoded by orjson (the path
+the product endpoints use). Checks that both produce the same bytes.
+
+    python benchmarks/bench_serialization.py --products 20000 --limit 500
+"""
+
+import argparse
+import asyncio
+import time
+
+from common import load_app, sandbox, seed
+
+
+async def pages(fetch, encode, queryset, limit: int, page_queryset):
+    rows = 0
+    bodies = []
+    after = None
+    while True:
+        products = await fetch(page_queryset(queryset, limit, after))
+        if not products:
+            return rows, bodies
+        bodies.append(encode({"status": "ok", "data": products, "next_cursor": None}))
+        rows += len(products)
+        last = products[-1]
+        after = last["id"] if isinstance(last, dict) else last.id
+
+
+async def main(args):
+    app = load_app()
+    await app.router.startup()
+    try:
+        from fastapi.encoders import jsonable_encoder
+        from fastapi.responses import JSONResponse
+
+        from catalog import PRODUCT_FIELDS, encode_response, page_queryset
+        from models import Product, product_pydantic
+
+        await seed(products=args.products, businesses=max(1, args.products // 1000))
+
+        paths = {
+            "pydantic + jsonable_encoder": (
+                product_pydantic.from_queryset,
+                lambda content: JSONResponse(jsonable_encoder(content)).body,
+            ),
+            "values + orjson": (
+                lambda queryset: queryset.values(*PRODUCT_FIELDS),
+                encode_response,
+            ),
+        }
+        results = {}
+        print(f"{'path':<28} {'rows/s':>10} {'seconds':>8}")
+        for name, (fetch, encode) in paths.items():
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                rows, bodies = await pages(
+                    fetch, encode, Product.all(), args.limit, page_queryset
+                )
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = bodies
+            print(f"{name:<28} {rows / best:>10.0f} {best:>8.3f}")
+
+        old, new = results.values()
+        if old != new:
+            raise SystemExit("serialized bodies differ")
+        print(f"identical output ({sum(map(len, new))} bytes)")
+    finally:
+        await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    sandbox()
+    asyncio.run(main(args))
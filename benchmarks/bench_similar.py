@@ -0,0 +1,96 @@
+"""
+Similar product queries against the in-memory feature matrix (similar.py) at
+several catalog sizes, with synthetic products: build time, memory of the
+index and peak RSS of the process, latency of a top-k query (one
+matrix-vector product) and of a single product update. No database is
+involved.
+
+    python benchmarks/bench_similar.py --products 10000 100000 500000
+"""
+
+import argparse
+import asyncio
+import random
+import resource
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from common import percentile, sandbox
+
+WORDS = (
+    "red blue green black white small large light heavy wireless leather cotton "
+    "steel wooden shoe boot jacket shirt lamp desk chair table phone case cable "
+    "charger laptop bag watch bottle mug pan knife towel pillow sofa bike helmet "
+    "ball racket tent camera lens speaker headset keyboard mouse screen"
+).split()
+CATEGORIES = [f"category{i}" for i in range(40)]
+
+
+def synthetic_rows(count: int, seed: int = 1):
+    rng = random.Random(seed)
+    today = date.today()
+    for product_id in range(1, count + 1):
+        yield (
+            product_id,
+            " ".join(rng.sample(WORDS, 3)),
+            rng.choice(CATEGORIES),
+            " ".join(rng.choices(WORDS, k=rng.randint(5, 30))),
+            Decimal(rng.randint(100, 500000)) / 100,
+            today + timedelta(days=rng.randint(-30, 365)),
+        )
+
+
+async def run(count: int, queries: int, k: int):
+    from similar import BUILD_BATCH_SIZE, SimilarProducts
+
+    index = SimilarProducts()
+    rows = list(synthetic_rows(count))
+    start = time.perf_counter()
+    for first in range(0, count, BUILD_BATCH_SIZE):
+        await index.add_rows(rows[first : first + BUILD_BATCH_SIZE])
+    build = time.perf_counter() - start
+
+    rng = random.Random(2)
+    latencies = []
+    for _ in range(queries):
+        product_id = rng.randint(1, count)
+        start = time.perf_counter()
+        await index.similar(product_id, k)
+        latencies.append(time.perf_counter() - start)
+
+    updates = []
+    for row in rng.sample(rows, min(1000, count)):
+        start = time.perf_counter()
+        index.upsert(row)
+        updates.append(time.perf_counter() - start)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on Linux
+    print(
+        f"{count:>9} {build:>8.2f} {index.stats()['bytes'] / 2**20:>9.1f} "
+        f"{rss / 2**20:>9.1f} {percentile(latencies, 50) * 1000:>8.2f} "
+        f"{percentile(latencies, 99) * 1000:>8.2f} "
+        f"{percentile(updates, 50) * 1e6:>10.1f}"
+    )
+
+
+async def main(args):
+    from similar import SIMILAR_DIMENSIONS
+
+    print(f"{SIMILAR_DIMENSIONS} feature columns, k={args.k}")
+    print(
+        f"{'products':>9} {'build s':>8} {'index MB':>9} {'rss MB':>9} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'update us':>10}"
+    )
+    for count in args.products:
+        await run(count, args.queries, args.k)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, nargs="+", default=[10000, 100000, 500000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    sandbox()
+    asyncio.run(main(args))
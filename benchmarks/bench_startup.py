@@ -0,0 +1,125 @@
+"""
+Startup cost of one worker: time to import main.py, to run the startup
+handlers and to answer the first request, on a new database (schema created)
+and on an existing one (schema current, DDL skipped). Each sample is a fresh
+interpreter.
+
+Results can be written with --output and compared with --baseline; the run
+fails (exit status 1) when a median grows by more than --threshold.
+
+    python benchmarks/bench_startup.py --runs 10 --output startup.json
+    python benchmarks/bench_startup.py --baseline startup.json --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from common import ROOT, sandbox
+
+# run in a child interpreter from the sandbox directory; prints one JSON line
+PROBE = """
+import asyncio, json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {benchmarks!r})
+from common import client, load_app
+app = load_app()
+imported = time.perf_counter()
+
+async def first_response():
+    await app.router.startup()
+    started = time.perf_counter()
+    async with client(app) as http:
+        response = await http.get("/product")
+        assert response.status_code == 200, response.text
+    answered = time.perf_counter()
+    await app.router.shutdown()
+    return started, answered
+
+started, answered = asyncio.run(first_response())
+print(json.dumps({{
+    "import": imported - start,
+    "startup": started - imported,
+    "first_response": answered - start,
+}}))
+"""
+
+METRICS = ["import", "startup", "first_response"]
+
+
+def sample() -> dict:
+    probe = PROBE.format(benchmarks=os.path.join(ROOT, "benchmarks"))
+    output = subprocess.run(
+        [sys.executable, "-c", probe],
+        check=True,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(runs: int, fresh: bool) -> dict:
+    samples = []
+    for _ in range(runs):
+        if fresh:
+            for name in ("db.sqlite3", "db.sqlite3-wal", "db.sqlite3-shm"):
+                if os.path.exists(name):
+                    os.remove(name)
+        samples.append(sample())
+    return {name: statistics.median(s[name] for s in samples) for name in METRICS}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for database, base in baseline["results"].items():
+        for name, value in base.items():
+            current = results[database][name]
+            if current > value * (1 + threshold):
+                regressions.append(
+                    f"{database} {name}: {value * 1000:.0f} ms -> {current * 1000:.0f} ms"
+                )
+    return regressions
+
+
+def main(args) -> int:
+    # an existing database is measured after one boot has created the schema
+    results = {"new database": measure(args.runs, fresh=True)}
+    results["existing database"] = measure(args.runs, fresh=False)
+
+    print(f"{'database':<18} {'import ms':>10} {'startup ms':>11} {'first response ms':>18}")
+    for database, medians in results.items():
+        print(
+            f"{database:<18} {medians['import'] * 1000:>10.0f} "
+            f"{medians['startup'] * 1000:>11.0f} {medians['first_response'] * 1000:>18.0f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"runs": args.runs, "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+    sandbox()
+    sys.exit(main(args))
@@ -0,0 +1,153 @@
+"""
+Shared helpers for the benchmark scripts.
+
+The app reads ``.env``, ``static/`` and ``templates/`` relative to the working
+directory and opens ``db.sqlite3`` there, so benchmarks run the real app from a
+throwaway directory that links back to the project files.
+"""
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sandbox(keep: bool = False, env: dict = None) -> str:
+    """
+    Switches into a temporary working directory with its own empty database.
+
+    Args:
+        keep (bool): Leave the directory behind on exit.
+        env (dict, optional): Extra ``.env`` settings for this run.
+
+    Returns:
+        str: The sandbox directory.
+    """
+    workdir = tempfile.mkdtemp(prefix="ecommerce-bench-")
+    for name in ("static", "templates"):
+        shutil.copytree(os.path.join(ROOT, name), os.path.join(workdir, name))
+    env_file = os.path.join(ROOT, ".env")
+    if os.path.exists(env_file):
+        shutil.copy(env_file, os.path.join(workdir, ".env"))
+    else:
+        with open(os.path.join(workdir, ".env"), "w") as f:
+            f.write("SECRET=benchmark\nEMAIL=bench@example.com\nPASSWORD=bench\n")
+    with open(os.path.join(workdir, ".env"), "a") as f:
+        for name, value in (env or {}).items():
+            f.write(f"\n{name}={value}\n")
+    os.chdir(workdir)
+    if not keep:
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return workdir
+
+
+def load_app():
+    """
+    Imports main.py inside the sandbox with email delivery and the expired
+    offer sweeper disabled.
+    """
+    import archive
+    import emails
+    import main
+
+    # verification emails stay queued in the outbox
+    emails.outbox_dispatcher.start = lambda: None
+    # seeded expired offers stay in the hot table unless a benchmark sweeps
+    archive.offer_sweeper.start = lambda: None
+    return main.app
+
+
+def client(app):
+    import httpx
+
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench"
+    )
+
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+@contextmanager
+def timer():
+    result = {}
+    start = time.perf_counter()
+    yield result
+    result["elapsed"] = time.perf_counter() - start
+
+
+WORDS = (
+    "red blue green black white leather cotton wireless smart portable classic "
+    "vintage organic steel wooden compact deluxe mini pro ultra lite shoe shirt "
+    "jacket watch phone laptop lamp chair table bottle backpack camera speaker "
+    "headphones keyboard mouse kettle blender mug pillow blanket sofa bike"
+).split()
+CATEGORIES = ["fashion", "tech", "home", "kitchen", "sports", "toys", "books", "beauty"]
+
+
+async def seed(users: int = 10, businesses: int = 10, products: int = 1000, seed: int = 1):
+    """
+    Fills the (empty) sandbox database with raw bulk inserts. Every user gets a
+    verified account with password "benchmark"; businesses are spread over the
+    users and products over the businesses.
+    """
+    import random
+    from datetime import date, datetime, timedelta
+
+    from tortoise import connections
+    from authentication import pwd_context
+
+    rng = random.Random(seed)
+    db = connections.get("default")
+    now = datetime.now()
+    password = pwd_context.hash("benchmark")
+
+    await db.execute_many(
+        'INSERT INTO "user" (id, username, email, password, is_verified, join_date) '
+        "VALUES (?, ?, ?, ?, 1, ?)",
+        [[i, f"user{i}", f"user{i}@example.com", password, now] for i in range(1, users + 1)],
+    )
+    await db.execute_many(
+        'INSERT INTO "business" (id, business_name, city, region, owner_id) '
+        "VALUES (?, ?, 'Unspecified', 'Unspecified', ?)",
+        [[i, f"business{i}", (i - 1) % users + 1] for i in range(1, businesses + 1)],
+    )
+    rows = []
+    for i in range(1, products + 1):
+        original = rng.randint(10, 1000)
+        new = rng.randint(1, original)
+        words = rng.sample(WORDS, 3)
+        rows.append(
+            [
+                i,
+                f"{' '.join(words[:2])} {i}",
+                rng.choice(CATEGORIES),
+                str(original),
+                str(new),
+                (original - new) * 100 // original,
+                date.today() + timedelta(days=rng.randint(-30, 90)),
+                " ".join(rng.choices(WORDS, k=12)),
+                now,
+                (i - 1) % businesses + 1,
+            ]
+        )
+        if len(rows) == 5000 or i == products:
+            await db.execute_many(
+                'INSERT INTO "product" (id, name, category, original_price, new_price, '
+                "percentage_discount, offer_expiriation_date, product_description, "
+                "date_published, business_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            rows = []
@@ -0,0 +1,258 @@
+"""
+Load test for the API: seeds a throwaway database, drives the app with a
+concurrent mix of requests and reports throughput and p50/p95/p99 latency per
+endpoint.
+
+By default the real FastAPI app runs in-process (httpx ASGITransport); with
+--uvicorn it is served by a local uvicorn process instead. Verification emails
+are never sent.
+
+Results can be written with --output and compared with --baseline; the run
+fails (exit status 1) when an endpoint's p95 latency or throughput regresses
+by more than --threshold.
+
+    python benchmarks/load_test.py --products 5000 --duration 20 --output run.json
+    python benchmarks/load_test.py --baseline run.json --threshold 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+from common import ROOT, client, load_app, percentile, sandbox, seed
+
+# endpoint -> share of the request mix
+MIX = {
+    "POST /token": 0.05,
+    "GET /product": 0.35,
+    "GET /product/{id}": 0.40,
+    "PUT /product/{id}": 0.15,
+    "POST /uploadfile/product/{id}": 0.05,
+}
+
+
+def png_bytes() -> bytes:
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new("RGB", (800, 600), (200, 80, 40)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class LoadTest:
+    def __init__(self, c, args):
+        self.c = c
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.samples = {name: [] for name in MIX}
+        self.errors = {name: 0 for name in MIX}
+        self.tokens = {}
+        self.image = png_bytes()
+
+    async def login(self, user: int) -> dict:
+        response = await self.c.post(
+            "/token", data={"username": f"user{user}", "password": "benchmark"}
+        )
+        response.raise_for_status()
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def owned_product(self, rng, user: int) -> int:
+        # common.seed gives business b to user (b - 1) % users + 1 and product p
+        # to business (p - 1) % businesses + 1
+        args = self.args
+        businesses = [b for b in range(1, args.businesses + 1) if (b - 1) % args.users + 1 == user]
+        business = rng.choice(businesses)
+        count = (args.products - business) // args.businesses + 1
+        return business + rng.randrange(count) * args.businesses
+
+    async def request(self, rng, name: str, user: int):
+        args, headers = self.args, self.tokens[user]
+        if name == "POST /token":
+            return await self.c.post(
+                "/token", data={"username": f"user{user}", "password": "benchmark"}
+            )
+        if name == "GET /product":
+            params = {"limit": 50}
+            if rng.random() < 0.5:
+                params["category"] = rng.choice(["tech", "home", "fashion", "toys"])
+            return await self.c.get("/product", params=params)
+        if name == "GET /product/{id}":
+            return await self.c.get(f"/product/{rng.randint(1, args.products)}")
+        product_id = self.owned_product(rng, user)
+        if name == "PUT /product/{id}":
+            return await self.c.put(
+                f"/product/{product_id}",
+                headers=headers,
+                json={
+                    "name": f"load product {product_id}",
+                    "category": "tech",
+                    "original_price": 100,
+                    "new_price": rng.randint(1, 100),
+                    "offer_expiriation_date": "2030-01-01",
+                },
+            )
+        return await self.c.post(
+            f"/uploadfile/product/{product_id}",
+            headers=headers,
+            files={"file": ("load.png", self.image, "image/png")},
+        )
+
+    async def worker(self, n: int, deadline: float):
+        rng = random.Random(self.args.seed * 1000 + n)
+        user = n % self.args.users + 1
+        names, weights = list(MIX), list(MIX.values())
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                response = await self.request(rng, name, user)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            self.samples[name].append(time.perf_counter() - start)
+            if not ok:
+                self.errors[name] += 1
+
+    async def run(self) -> dict:
+        args = self.args
+        for user in range(1, min(args.users, args.concurrency) + 1):
+            self.tokens[user] = await self.login(user)
+        deadline = time.perf_counter() + args.duration
+        await asyncio.gather(*(self.worker(n, deadline) for n in range(args.concurrency)))
+        return {
+            name: {
+                "requests": len(samples),
+                "errors": self.errors[name],
+                "throughput": len(samples) / args.duration,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+            }
+            for name, samples in self.samples.items()
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_in_process(args) -> dict:
+    app = load_app()
+    await app.router.startup()
+    try:
+        await seed(args.users, args.businesses, args.products, args.seed)
+        async with client(app) as c:
+            return await LoadTest(c, args).run()
+    finally:
+        await app.router.shutdown()
+
+
+async def run_uvicorn(args) -> dict:
+    import httpx
+    from tortoise import Tortoise
+
+    from database import tortoise_config
+
+    await Tortoise.init(config=tortoise_config())
+    await Tortoise.generate_schemas()
+    await seed(args.users, args.businesses, args.products, args.seed)
+    await Tortoise.close_connections()
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        env={**os.environ, "PYTHONPATH": ROOT},
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as c:
+            for _ in range(100):
+                try:
+                    await c.get("/")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            return await LoadTest(c, args).run()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for name, base in baseline["endpoints"].items():
+        current = results["endpoints"].get(name)
+        if current is None or not base["requests"]:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {base['p95_ms']:.1f}ms -> {current['p95_ms']:.1f}ms")
+        if current["throughput"] < base["throughput"] * (1 - threshold):
+            regressions.append(
+                f"{name}: throughput {base['throughput']:.1f}/s -> {current['throughput']:.1f}/s"
+            )
+    return regressions
+
+
+def main(args) -> int:
+    config = {
+        key: getattr(args, key)
+        for key in ("users", "businesses", "products", "concurrency", "duration", "seed", "uvicorn")
+    }
+    runner = run_uvicorn if args.uvicorn else run_in_process
+    results = {"config": config, "endpoints": asyncio.run(runner(args))}
+
+    print(f"{'endpoint':<32} {'reqs':>6} {'errs':>5} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, r in results["endpoints"].items():
+        print(
+            f"{name:<32} {r['requests']:>6} {r['errors']:>5} {r['throughput']:>8.1f} "
+            f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print("warning: baseline was recorded with a different configuration")
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--businesses", type=int, default=20)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--uvicorn", action="store_true", help="serve the app with uvicorn")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+    if args.businesses < args.users:
+        parser.error("--businesses must be at least --users so every user owns a business")
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+    # verification emails go nowhere, even from a uvicorn server
+    sandbox(env={"MAIL_SERVER": "127.0.0.1", "MAIL_PORT": 9, "MAIL_STARTTLS": "false"})
+    sys.exit(main(args))
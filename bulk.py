@@ -0,0 +1,283 @@
+import codecs
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi import HTTPException, status
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from tortoise.exceptions import IntegrityError
+from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
+
+from catalog import page_queryset
+from models import Business, Product, product_pydanticIn
+from settings import settings
+
+# rows validated and inserted per transaction
+IMPORT_BATCH_SIZE = settings.IMPORT_BATCH_SIZE
+# per-row errors listed in the import report; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+EXPORT_FIELDS = [
+    "id",
+    "name",
+    "category",
+    "original_price",
+    "new_price",
+    "percentage_discount",
+    "offer_expiriation_date",
+    "product_description",
+    "product_image",
+    "date_published",
+]
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Splits a streamed UTF-8 body into lines without reading it all into memory.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def iter_ndjson_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[object]:
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as exc:
+            yield exc
+
+
+async def iter_csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[object]:
+    header = None
+    record = ""
+    async for line in iter_lines(chunks):
+        record = f"{record}\n{line}" if record else line
+        # a quoted field can span lines: wait until the quotes are balanced
+        if record.count('"') % 2:
+            continue
+        values = next(csv.reader(io.StringIO(record)), [])
+        record = ""
+        if not values:
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+        elif len(values) != len(header):
+            yield ValueError(f"Expected {len(header)} columns, got {len(values)}.")
+        else:
+            # empty cells mean "not set" so optional fields keep their defaults
+            yield {name: value for name, value in zip(header, values) if value != ""}
+
+
+def row_errors(exc: Exception) -> List[Dict[str, str]]:
+    if isinstance(exc, ValidationError):
+        return [
+            {"field": ".".join(str(part) for part in error["loc"]), "msg": error["msg"]}
+            for error in exc.errors()
+        ]
+    return [{"field": "", "msg": str(exc)}]
+
+
+class ProductImport:
+    """
+    Validates product rows and inserts them for one business in chunked
+    transactions, collecting per-row errors instead of aborting.
+    """
+
+    def __init__(self, business: Business):
+        self.business = business
+        self.created = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+        self._batch: List[tuple] = []
+
+    def error(self, row_number: int, errors: List[Dict[str, str]]) -> None:
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row_number, "errors": errors})
+
+    async def add(self, row_number: int, row: object) -> None:
+        if isinstance(row, Exception):
+            self.error(row_number, row_errors(row))
+            return
+        try:
+            product = product_pydanticIn.model_validate(row)
+        except ValidationError as exc:
+            self.error(row_number, row_errors(exc))
+            return
+        if product.original_price <= 0:
+            self.error(
+                row_number,
+                [{"field": "original_price", "msg": "Original price must be greater than 0."}],
+            )
+            return
+        self._batch.append((row_number, product.model_dump(exclude_unset=True)))
+        if len(self._batch) >= IMPORT_BATCH_SIZE:
+            await self.flush()
+
+    async def flush(self) -> None:
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        # names are unique: report clashes up front rather than failing the chunk
+        names = [info["name"] for _, info in batch]
+        taken = set(await Product.filter(name__in=names).values_list("name", flat=True))
+        rows = []
+        for row_number, info in batch:
+            if info["name"] in taken:
+                self.error(row_number, [{"field": "name", "msg": "Product name already exists."}])
+                continue
+            taken.add(info["name"])
+            rows.append((row_number, info))
+
+        # discount for the whole chunk at once
+        discounts = [
+            int((info["original_price"] - info["new_price"]) / info["original_price"] * 100)
+            for _, info in rows
+        ]
+        products = [
+            Product(**info, percentage_discount=discount, business=self.business)
+            for (_, info), discount in zip(rows, discounts)
+        ]
+        try:
+            async with in_transaction("default") as connection:
+                await Product.bulk_create(products, using_db=connection)
+            self.created += len(products)
+        except IntegrityError:
+            # lost a race on a name: fall back to one insert per row
+            for (row_number, _), product in zip(rows, products):
+                try:
+                    await product.save()
+                    self.created += 1
+                except IntegrityError as exc:
+                    self.error(row_number, row_errors(exc))
+
+    def report(self) -> dict:
+        return {
+            "created": self.created,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda error: error["row"]),
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+class ProductChange(BaseModel):
+    # fields left out are not changed; prices cannot be set to null
+    id: int
+    original_price: Optional[Decimal] = Field(None, gt=0)
+    new_price: Optional[Decimal] = None
+    product_description: Optional[str] = None
+
+    @field_validator("original_price", "new_price")
+    @classmethod
+    def _price_given(cls, value: Optional[Decimal]) -> Decimal:
+        # only runs for fields in the request, so None here is an explicit null
+        if value is None:
+            raise ValueError("Prices cannot be null.")
+        return value
+
+
+async def update_products(owner_id: int, changes: List[ProductChange]) -> List[Product]:
+    """
+    Applies price and description changes to products of one owner in a
+    single transaction: one query loads the products with their owners, one
+    UPDATE writes them all. Nothing is written if any product is missing or
+    belongs to someone else.
+
+    Raises:
+        HTTPException: 404 for unknown products, 401 for products of other owners.
+
+    Returns:
+        list: The updated products, in request order.
+    """
+    ids = list(dict.fromkeys(change.id for change in changes))
+    async with in_transaction("default") as connection:
+        products = {
+            product.id: product
+            for product in await Product.filter(id__in=ids)
+            .select_related("business")
+            .using_db(connection)
+        }
+        missing = [product_id for product_id in ids if product_id not in products]
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Products not found: {missing}",
+            )
+        if any(product.business.owner_id != owner_id for product in products.values()):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Not authenticated to perform this action.",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+
+        fields = {"percentage_discount", "date_published", "version"}
+        now = datetime.now()
+        for change in changes:
+            product = products[change.id]
+            values = change.model_dump(exclude_unset=True, exclude={"id"})
+            product.update_from_dict(values)
+            fields.update(values)
+            product.percentage_discount = int(
+                (product.original_price - product.new_price) / product.original_price * 100
+            )
+            product.date_published = now
+            product.version += 1
+        await Product.bulk_update(
+            list(products.values()), fields=sorted(fields), using_db=connection
+        )
+    return [products[product_id] for product_id in ids]
+
+
+async def import_products(
+    business: Business, chunks: AsyncIterator[bytes], file_format: str
+) -> dict:
+    """
+    Imports products for ``business`` from a streamed CSV or NDJSON body.
+
+    Returns:
+        dict: Counts of created and failed rows and the per-row errors.
+    """
+    rows = iter_csv_rows(chunks) if file_format == "csv" else iter_ndjson_rows(chunks)
+    importer = ProductImport(business)
+    row_number = 0
+    async for row in rows:
+        row_number += 1
+        await importer.add(row_number, row)
+    await importer.flush()
+    return importer.report()
+
+
+async def export_products_csv(
+    queryset: QuerySet[Product], batch_size: int = 1000
+) -> AsyncIterator[str]:
+    """
+    Yields a CSV export of the queryset, reading it in keyset batches.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    after = None
+    while True:
+        rows = await page_queryset(queryset, batch_size, after).values(*EXPORT_FIELDS)
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        if len(rows) < batch_size:
+            break
+        after = rows[-1]["id"]
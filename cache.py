@@ -0,0 +1,232 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, NamedTuple, Optional
+
+from tortoise.transactions import in_transaction
+
+from models import CacheInvalidation
+
+
+class TTLCache:
+    """
+    A small in-process LRU cache whose entries also expire after ``ttl`` seconds.
+
+    Args:
+        maxsize (int): Maximum number of entries before the least recently used is evicted.
+        ttl (float): Seconds an entry stays valid.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        item = self._data.pop(key, None)
+        return item[1] if item is not None else None
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    headers: Dict[str, str]
+
+
+class LocalInvalidation:
+    """
+    Invalidation backend for a single worker: nothing to share.
+    """
+
+    async def publish(self, tags: Iterable[str]) -> None:
+        pass
+
+    async def poll(self) -> List[str]:
+        return []
+
+
+class SQLiteInvalidation:
+    """
+    Shares invalidations between workers through a log table in the app
+    database. Each worker reads the tags published since its last poll, at most
+    once every ``interval`` seconds, so other workers serve stale entries for
+    at most that long.
+    """
+
+    def __init__(self, interval: float = 0.5, keep: int = 10000):
+        self.interval = interval
+        self.keep = keep
+        self._last_id: Optional[int] = None
+        self._next_poll = 0.0
+
+    async def publish(self, tags: Iterable[str]) -> None:
+        rows = [CacheInvalidation(tag=tag) for tag in tags]
+        if not rows:
+            return
+        # one write transaction however many tags a bulk write invalidates
+        async with in_transaction("default") as connection:
+            await CacheInvalidation.bulk_create(rows, using_db=connection)
+            last_id = (
+                await CacheInvalidation.all()
+                .using_db(connection)
+                .order_by("-id")
+                .first()
+                .values_list("id", flat=True)
+            )
+            # trim the log now and then
+            if last_id // 1000 != (last_id - len(rows)) // 1000:
+                await CacheInvalidation.filter(id__lte=last_id - self.keep).using_db(
+                    connection
+                ).delete()
+
+    async def poll(self) -> List[str]:
+        now = time.monotonic()
+        if now < self._next_poll:
+            return []
+        self._next_poll = now + self.interval
+        if self._last_id is None:
+            last = await CacheInvalidation.all().order_by("-id").first()
+            self._last_id = last.id if last else 0
+            return []
+        rows = await CacheInvalidation.filter(id__gt=self._last_id).order_by("id").values_list(
+            "id", "tag"
+        )
+        if rows:
+            self._last_id = rows[-1][0]
+        return [tag for _, tag in rows]
+
+
+class ResponseCache:
+    """
+    LRU cache of encoded response bodies, bounded by total size. Entries carry
+    tags (e.g. "product:3") and are dropped when one of their tags is invalidated.
+
+    Args:
+        max_bytes (int): Total size of the cached bodies before eviction.
+        backend: Shares invalidations with other workers (``LocalInvalidation``
+            or ``SQLiteInvalidation``).
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, backend=None):
+        self.max_bytes = max_bytes
+        self.backend = backend or LocalInvalidation()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # bumped by every invalidation so a response computed before it is not stored
+        self.generation = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._tags: Dict[str, set] = {}
+
+    async def sync(self) -> None:
+        """
+        Applies the invalidations published through the backend since the
+        last call.
+        """
+        tags = await self.backend.poll()
+        if not tags:
+            return
+        for tag in tags:
+            self._drop_tag(tag)
+
+    async def get(self, key: Hashable) -> Optional[CachedResponse]:
+        await self.sync()
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(
+        self, key: Hashable, value: CachedResponse, tags: Iterable[str], generation: int
+    ) -> None:
+        """
+        Stores a response, unless something was invalidated since ``generation``
+        was read (the response may already be stale).
+        """
+        if generation != self.generation or len(value.body) > self.max_bytes:
+            return
+        self._remove(key)
+        tags = tuple(tags)
+        self._data[key] = (value, tags)
+        self.size += len(value.body)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._data)))
+
+    async def invalidate(self, *tags: str) -> None:
+        for tag in tags:
+            self._drop_tag(tag)
+        await self.backend.publish(tags)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._data.clear()
+        self._tags.clear()
+        self.size = 0
+
+    def _drop_tag(self, tag: str) -> None:
+        self.generation += 1
+        for key in self._tags.pop(tag, ()):
+            self._remove(key)
+
+    def _remove(self, key: Hashable) -> None:
+        item = self._data.pop(key, None)
+        if item is None:
+            return
+        value, tags = item
+        self.size -= len(value.body)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
@@ -0,0 +1,360 @@
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import orjson
+from pydantic import BaseModel
+from tortoise import connections
+from tortoise.exceptions import DoesNotExist
+from tortoise.expressions import RawSQL
+from tortoise.functions import Count
+from tortoise.queryset import QuerySet
+
+from cache import LocalInvalidation, ResponseCache, SQLiteInvalidation
+from database import read_connection
+from models import ArchivedProduct, Business, Product
+from settings import settings
+
+# page size limits for the product listing
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# rows pulled from the database per round trip when streaming
+STREAM_BATCH_SIZE = 500
+
+# encoded /product and /product/{id} responses; RESPONSE_CACHE_BACKEND=sqlite
+# shares invalidations between workers through the database
+response_cache = ResponseCache(
+    max_bytes=settings.RESPONSE_CACHE_BYTES,
+    backend=SQLiteInvalidation()
+    if settings.RESPONSE_CACHE_BACKEND == "sqlite"
+    else LocalInvalidation(),
+)
+
+# the fields product_pydantic serializes, in its order; read with .values() so
+# listings skip building ORM and pydantic objects
+PRODUCT_FIELDS = tuple(
+    name for name in Product._meta.fields_map if name not in ("business", "business_id")
+)
+
+# Decimal fields are stored as text in SQLite, so prices are compared (and
+# indexed) as CAST(new_price AS REAL)
+PRICE_SQL = 'CAST("new_price" AS REAL)'
+PRICE_INDEXES = """
+CREATE INDEX IF NOT EXISTS "idx_product_price" ON "product" (CAST("new_price" AS REAL));
+CREATE INDEX IF NOT EXISTS "idx_product_category_price"
+    ON "product" ("category", CAST("new_price" AS REAL));
+CREATE INDEX IF NOT EXISTS "idx_product_business_price"
+    ON "product" ("business_id", CAST("new_price" AS REAL));
+"""
+
+# storefront summary of one business, aggregated in SQL over the business_id
+# indexes
+STOREFRONT_SUMMARY_SQL = f"""
+SELECT count(*) AS "product_count",
+    avg("percentage_discount") AS "average_discount",
+    max("percentage_discount") AS "max_discount",
+    min({PRICE_SQL}) AS "min_price",
+    max({PRICE_SQL}) AS "max_price"
+FROM "product" WHERE "business_id" = ?
+"""
+STOREFRONT_CATEGORIES_SQL = """
+SELECT "category", count(*) AS "count" FROM "product" WHERE "business_id" = ?
+GROUP BY "category" ORDER BY "category"
+"""
+
+# upper bounds of the price facet buckets; the last bucket is open ended
+PRICE_BUCKETS = [25, 50, 100, 250, 500, 1000]
+
+
+class ProductFilters(BaseModel):
+    category: Optional[str] = None
+    min_price: Optional[Decimal] = None
+    max_price: Optional[Decimal] = None
+    min_discount: Optional[int] = None
+    business_id: Optional[int] = None
+    active: bool = False  # only offers that have not expired
+
+
+async def ensure_catalog_indexes() -> None:
+    await connections.get("default").execute_script(PRICE_INDEXES)
+
+
+def filter_products(
+    queryset: QuerySet[Product], filters: ProductFilters
+) -> Tuple[QuerySet[Product], str]:
+    """
+    Applies the listing filters to a product queryset.
+
+    Returns:
+        tuple: The filtered queryset and the field to paginate on. Filter sets
+        made only of ranges paginate on ``+id`` so SQLite drives the query from
+        the range index instead of walking the whole table in id order.
+    """
+    if filters.min_price is not None or filters.max_price is not None:
+        queryset = queryset.annotate(price=RawSQL(PRICE_SQL))
+        if filters.min_price is not None:
+            queryset = queryset.filter(price__gte=float(filters.min_price))
+        if filters.max_price is not None:
+            queryset = queryset.filter(price__lte=float(filters.max_price))
+    if filters.min_discount is not None:
+        queryset = queryset.filter(percentage_discount__gte=filters.min_discount)
+    if filters.active:
+        queryset = queryset.filter(offer_expiriation_date__gte=date.today())
+    if filters.category is not None:
+        queryset = queryset.filter(category=filters.category)
+    if filters.business_id is not None:
+        queryset = queryset.filter(business_id=filters.business_id)
+
+    has_range = (
+        filters.min_price is not None
+        or filters.max_price is not None
+        or filters.min_discount is not None
+        or filters.active
+    )
+    if has_range and filters.category is None and filters.business_id is None:
+        return queryset.annotate(sort_id=RawSQL('+"id"')), "sort_id"
+    return queryset, "id"
+
+
+def price_bucket_sql() -> str:
+    bucket_sql = "CASE"
+    lower = 0
+    for upper in PRICE_BUCKETS:
+        bucket_sql += f" WHEN {PRICE_SQL} < {upper} THEN '{lower}-{upper}'"
+        lower = upper
+    return bucket_sql + f" ELSE '{lower}+' END"
+
+
+def facet_querysets(queryset: QuerySet[Product]) -> Tuple[QuerySet, QuerySet]:
+    """
+    Builds the GROUP BY queries behind ``product_facets``. Grouping on
+    ``+category`` keeps SQLite on the filter's index rather than walking the
+    whole category index to get rows already grouped.
+    """
+    categories = (
+        queryset.annotate(facet=RawSQL('+"category"'), count=Count("id"))
+        .group_by("facet")
+        .order_by("facet")
+        .values("facet", "count")
+    )
+    prices = (
+        queryset.annotate(facet=RawSQL(price_bucket_sql()), count=Count("id"))
+        .group_by("facet")
+        .values("facet", "count")
+    )
+    return categories, prices
+
+
+async def product_facets(*querysets: QuerySet) -> Dict[str, list]:
+    """
+    Counts the products of one or more (filtered) querysets per category and
+    per price bucket, grouped in SQL.
+    """
+    category_counts: Dict[str, int] = {}
+    buckets: Dict[str, int] = {}
+    for queryset in querysets:
+        categories, prices = facet_querysets(queryset)
+        for row in await categories:
+            category_counts[row["facet"]] = category_counts.get(row["facet"], 0) + row["count"]
+        for row in await prices:
+            buckets[row["facet"]] = buckets.get(row["facet"], 0) + row["count"]
+    bounds = [0] + PRICE_BUCKETS
+    labels = [f"{a}-{b}" for a, b in zip(bounds, bounds[1:])] + [f"{bounds[-1]}+"]
+    return {
+        "category": [
+            {"category": category, "count": count}
+            for category, count in sorted(category_counts.items())
+        ],
+        "price": [{"bucket": label, "count": buckets.get(label, 0)} for label in labels],
+    }
+
+
+async def storefront_summary(business_id: int) -> Dict[str, Any]:
+    """
+    Summarizes the catalog of one business: product count, products per
+    category, average and maximum discount and price range.
+    """
+    db = read_connection()
+    summary = (await db.execute_query_dict(STOREFRONT_SUMMARY_SQL, [business_id]))[0]
+    categories = await db.execute_query_dict(STOREFRONT_CATEGORIES_SQL, [business_id])
+    average = summary["average_discount"]
+    return {
+        "business_id": business_id,
+        "product_count": summary["product_count"],
+        "categories": categories,
+        "discount": {
+            "average": round(average, 2) if average is not None else None,
+            "max": summary["max_discount"],
+        },
+        "price": {"min": summary["min_price"], "max": summary["max_price"]},
+    }
+
+
+def page_queryset(
+    queryset: QuerySet[Product], limit: int, after: Optional[int] = None, key: str = "id"
+) -> QuerySet[Product]:
+    if after is not None:
+        queryset = queryset.filter(**{f"{key}__gt": after})
+    return queryset.order_by(key).limit(limit)
+
+
+async def product_page(
+    queryset: QuerySet[Product],
+    limit: int,
+    after: Optional[int] = None,
+    key: str = "id",
+    archived: Optional[QuerySet[ArchivedProduct]] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """
+    Fetches one page of products using keyset pagination on the primary key.
+
+    Args:
+        queryset (QuerySet): The base product queryset (filters already applied).
+        limit (int): Maximum number of products to return.
+        after (int, optional): Only return products with an id greater than this.
+        key (str): Field holding the id to paginate on, see ``filter_products``.
+        archived (QuerySet, optional): Archived products to merge into the page.
+
+    Returns:
+        tuple: The products (``PRODUCT_FIELDS`` values, see ``encode_response``)
+        and the cursor for the next page (None when there are no more rows).
+    """
+    # fetch one extra row to know whether another page exists
+    products = await page_queryset(queryset, limit + 1, after, key).values(*PRODUCT_FIELDS)
+    if archived is not None:
+        # ids are unique across both tables, so the two pages merge on id
+        products += await page_queryset(archived, limit + 1, after, key).values(
+            *PRODUCT_FIELDS
+        )
+        products = sorted(products, key=lambda product: product["id"])[: limit + 1]
+    if len(products) > limit:
+        return products[:limit], products[limit - 1]["id"]
+    return products, None
+
+
+async def stream_products(
+    queryset: QuerySet[Product],
+    after: Optional[int] = None,
+    key: str = "id",
+    batch_size: int = STREAM_BATCH_SIZE,
+    archived: Optional[QuerySet[ArchivedProduct]] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Yields products as NDJSON lines, reading the table in keyset batches so
+    memory stays constant whatever the catalog size.
+    """
+    while True:
+        products, after = await product_page(
+            queryset, batch_size, after, key, archived
+        )
+        for product in products:
+            yield encode_response(product) + b"\n"
+        if after is None:
+            break
+
+
+async def get_product_with_business(product_id: int, include_archived: bool = False) -> Product:
+    """
+    Loads a product together with its business and the business owner in a
+    single joined query.
+
+    Args:
+        include_archived (bool): Fall back to the expired offers the sweeper
+            moved out of ``product``, returning an ``ArchivedProduct``.
+
+    Raises:
+        DoesNotExist: If there is no product with this id.
+    """
+    try:
+        return await Product.filter(id=product_id).select_related("business__owner").get()
+    except DoesNotExist:
+        if not include_archived:
+            raise
+        archived = (
+            await ArchivedProduct.filter(id=product_id).select_related("business__owner").first()
+        )
+        if archived is None:
+            raise
+        return archived
+
+
+def product_values(product: Product) -> Dict[str, Any]:
+    """
+    The ``PRODUCT_FIELDS`` values of a loaded product, as listings return them.
+    """
+    values = {name: getattr(product, name) for name in PRODUCT_FIELDS}
+    # a product from Product.create (or one changed in memory) still holds the
+    # values it was built with: a Decimal discount, by default a datetime
+    # expiry date and a naive date_published, which Tortoise reads back as an
+    # aware datetime in its timezone (UTC), encoded with "Z"
+    values["percentage_discount"] = int(values["percentage_discount"])
+    if isinstance(values["offer_expiriation_date"], datetime):
+        values["offer_expiriation_date"] = values["offer_expiriation_date"].date()
+    published = product._meta.fields_map["date_published"]
+    values["date_published"] = published.to_python_value(values["date_published"])
+    return values
+
+
+def product_detail(product: Product) -> Dict[str, Any]:
+    """
+    The product page body: the product and its business. Needs
+    ``get_product_with_business`` (or the same ``select_related``).
+    """
+    business = product.business
+    owner = business.owner
+    return {
+        "product_details": product_values(product),
+        "business_details": {
+            "name": business.business_name,
+            "city": business.city,
+            "region": business.region,
+            "business_description": business.business_description,
+            "logo": f"localhost:8000/static/images/profile_images/{business.logo}",
+            "owner_id": owner.id,
+            "business_id": business.id,
+            "email": owner.email,
+            "joined_date": owner.join_date.strftime("%b-%m-%Y"),
+        },
+    }
+
+
+def product_etag(product: Product) -> str:
+    """
+    Strong ETag of the product page: the product and business row versions,
+    which every write bumps. Needs ``product.business`` loaded.
+    """
+    return f'"{product.version}.{product.business.version}"'
+
+
+def business_etag(business: Business) -> str:
+    return f'"{business.version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Checks an ``If-None-Match`` header against an ETag.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def _encode_default(value):
+    # the formats pydantic uses for the product models
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def encode_response(content) -> bytes:
+    """
+    Encodes a response body with orjson, byte for byte like FastAPI's default
+    JSON response for the product models: compact separators, UTF-8, Decimal
+    as a string and UTC datetimes ending in "Z".
+    """
+    return orjson.dumps(content, default=_encode_default, option=orjson.OPT_UTC_Z)
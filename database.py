@@ -0,0 +1,132 @@
+import hashlib
+import itertools
+from typing import Optional
+
+from tortoise import BaseDBAsyncClient, connections
+from tortoise.backends.base.config_generator import expand_db_url
+from tortoise.utils import get_schema_sql
+
+from settings import settings
+
+DATABASE_URL = settings.DATABASE_URL
+
+# read-only connections used next to the single writer (SQLite only, 0 disables)
+DB_READERS = settings.DB_READERS
+
+# applied to every SQLite connection when it is opened
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": settings.SQLITE_SYNCHRONOUS,
+    "mmap_size": settings.SQLITE_MMAP_SIZE,
+    "cache_size": settings.SQLITE_CACHE_SIZE,
+    "busy_timeout": settings.SQLITE_BUSY_TIMEOUT,
+    "temp_store": "MEMORY",
+}
+
+READER_NAMES = []
+
+# columns added to tables that already existed; generate_schemas only creates
+# missing tables, so add_missing_columns adds these to older databases
+ADDED_COLUMNS = (
+    ("business", "version", "INT NOT NULL DEFAULT 1"),
+    ("product", "version", "INT NOT NULL DEFAULT 1"),
+    ("product_archive", "version", "INT NOT NULL DEFAULT 1"),
+)
+
+
+def tortoise_config(db_url: str = DATABASE_URL, readers: int = DB_READERS) -> dict:
+    """
+    Builds the Tortoise config: a "default" connection that takes every write
+    and, for file-backed SQLite, ``readers`` query-only connections that
+    ``ReadWriteRouter`` spreads the reads over.
+    """
+    default = expand_db_url(db_url)
+    config = {
+        "connections": {"default": default},
+        "apps": {"models": {"models": ["models"], "default_connection": "default"}},
+    }
+    if default["engine"] != "tortoise.backends.sqlite":
+        return config
+
+    default["credentials"].update(SQLITE_PRAGMAS)
+    if default["credentials"]["file_path"] == ":memory:":
+        return config
+
+    READER_NAMES[:] = [f"reader{i}" for i in range(readers)]
+    for name in READER_NAMES:
+        reader = expand_db_url(db_url)
+        reader["credentials"].update(SQLITE_PRAGMAS, query_only="ON")
+        config["connections"][name] = reader
+    if READER_NAMES:
+        config["routers"] = ["database.ReadWriteRouter"]
+    return config
+
+
+_next_reader = itertools.count()
+
+
+def reader_name() -> str:
+    if not READER_NAMES:
+        return "default"
+    return READER_NAMES[next(_next_reader) % len(READER_NAMES)]
+
+
+class ReadWriteRouter:
+    """
+    Sends ORM reads to the reader connections in turn and writes to "default".
+    Reads that must see an open transaction's writes need ``using_db``.
+    """
+
+    def db_for_read(self, model):
+        return reader_name()
+
+    def db_for_write(self, model):
+        return "default"
+
+
+def read_connection() -> BaseDBAsyncClient:
+    """
+    Connection for raw read-only SQL.
+    """
+    return connections.get(reader_name())
+
+
+def schema_version(*scripts: str) -> int:
+    """
+    Fingerprint of the schema the app expects: the DDL generated for the models
+    plus ``scripts`` (extra DDL such as indexes and triggers). Fits in SQLite's
+    32-bit ``user_version``.
+    """
+    schema = get_schema_sql(connections.get("default"), safe=True) + "".join(scripts)
+    return int(hashlib.sha1(schema.encode()).hexdigest()[:7], 16)
+
+
+async def stored_schema_version() -> Optional[int]:
+    """
+    The version recorded by ``store_schema_version``, None if the database
+    cannot record one (not SQLite).
+    """
+    db = connections.get("default")
+    if db.capabilities.dialect != "sqlite":
+        return None
+    return (await db.execute_query_dict("PRAGMA user_version"))[0]["user_version"]
+
+
+async def store_schema_version(version: int) -> None:
+    db = connections.get("default")
+    if db.capabilities.dialect == "sqlite":
+        await db.execute_script(f"PRAGMA user_version = {int(version)}")
+
+
+async def add_missing_columns(columns=ADDED_COLUMNS) -> None:
+    """
+    Adds ``columns`` (table, column, DDL type) to existing SQLite tables that
+    lack them. Tables that do not exist yet are left to generate_schemas.
+    """
+    db = connections.get("default")
+    if db.capabilities.dialect != "sqlite":
+        return
+    for table, column, ddl in columns:
+        existing = await db.execute_query_dict(f'PRAGMA table_info("{table}")')
+        if existing and column not in {row["name"] for row in existing}:
+            await db.execute_script(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {ddl}')
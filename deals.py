@@ -0,0 +1,207 @@
+"""
+In-memory leaderboards of the best live discounts, one over the whole catalog
+and one per category, served by GET /deals/top.
+
+Each board holds the top ``BOARD_SIZE`` live offers in discount order. The
+boards are filled from the discount indexes at startup and kept current from
+the change feed (``ChangeFeed.follow``), so writes in every worker reach them,
+each change costing a binary search in the board. A board is only read again
+from the database when expired or removed offers leave it with fewer than
+``k`` entries.
+"""
+
+import bisect
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+from tortoise.queryset import QuerySet
+
+from catalog import PRODUCT_FIELDS
+from feed import change_feed
+from models import Product
+from settings import settings
+
+# largest k served; boards keep twice as many so that removals rarely force a
+# refill
+DEALS_MAX_K = settings.DEALS_MAX_K
+BOARD_SIZE = 2 * DEALS_MAX_K
+
+# refills retried when the board changed while the rows were read
+FILL_ATTEMPTS = 3
+
+
+def _key(deal: Dict[str, Any]) -> Tuple[int, int]:
+    # best discount first, newest product first among equal discounts
+    return (-deal["percentage_discount"], -deal["id"])
+
+
+class DealBoard:
+    """
+    The best live offers of one category (or of all, ``category=None``).
+
+    Unless the board is complete (it holds every live offer it covers), it
+    only knows the offers ranked above its last entry, so changes below that
+    entry are ignored and a short board is refilled.
+    """
+
+    def __init__(self, category: Optional[str], size: int = BOARD_SIZE):
+        self.category = category
+        self.size = size
+        self.filled = False
+        self.complete = False
+        self._keys: List[Tuple[int, int]] = []
+        self._deals: Dict[int, Dict[str, Any]] = {}
+        # bumped by every change, so a fill can tell it raced with a write
+        self._changes = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def clear(self) -> None:
+        self._keys, self._deals = [], {}
+        self.filled = self.complete = False
+        self._changes += 1
+
+    def discard(self, product_id: int) -> None:
+        self._changes += 1
+        deal = self._deals.pop(product_id, None)
+        if deal is not None:
+            del self._keys[bisect.bisect_left(self._keys, _key(deal))]
+
+    def upsert(self, deal: Dict[str, Any], today: date) -> None:
+        self.discard(deal["id"])
+        if not self.filled or deal["offer_expiriation_date"] < today:
+            return
+        if self.category is not None and deal["category"] != self.category:
+            return
+        key = _key(deal)
+        if not self.complete and (not self._keys or key > self._keys[-1]):
+            return
+        bisect.insort(self._keys, key)
+        self._deals[deal["id"]] = deal
+        if len(self._keys) > self.size:
+            del self._deals[-self._keys.pop()[1]]
+            self.complete = False
+
+    def top(self, k: int, today: date) -> Optional[List[Dict[str, Any]]]:
+        """
+        The best ``k`` live offers, dropping the expired ones on the way.
+        None when the board has to be refilled first.
+        """
+        if not self.filled:
+            return None
+        deals, expired = [], []
+        for key in self._keys:
+            deal = self._deals[-key[1]]
+            if deal["offer_expiriation_date"] < today:
+                expired.append(deal["id"])
+                continue
+            deals.append(deal)
+            if len(deals) == k:
+                break
+        for product_id in expired:
+            self.discard(product_id)
+        if len(deals) < k and not self.complete:
+            return None
+        return deals
+
+    def queryset(self, today: date) -> QuerySet:
+        queryset = Product.filter(offer_expiriation_date__gte=today)
+        if self.category is not None:
+            queryset = queryset.filter(category=self.category)
+        return queryset.order_by("-percentage_discount", "-id").limit(self.size)
+
+    async def fill(self, today: date) -> None:
+        queryset = self.queryset(today)
+        for _ in range(FILL_ATTEMPTS):
+            changes = self._changes
+            rows = await queryset.values(*PRODUCT_FIELDS)
+            if changes == self._changes:
+                break
+        self._deals = {row["id"]: row for row in rows}
+        self._keys = sorted(map(_key, rows))
+        self.complete = len(rows) < self.size
+        self.filled = True
+
+
+class TopDeals:
+    """
+    The global board and the per-category boards, updated together.
+    """
+
+    def __init__(self, size: int = BOARD_SIZE):
+        self.size = size
+        self.boards: Dict[Optional[str], DealBoard] = {None: DealBoard(None, size)}
+        self.refills = 0
+
+    async def build(self) -> None:
+        """
+        Fills the global board and a board for every category in use.
+        """
+        # changes from here on reach on_change; a board that changes while it
+        # is filled reads its rows again (DealBoard.fill)
+        await change_feed.follow(self.on_change)
+        categories = await Product.all().distinct().values_list("category", flat=True)
+        boards = {None: DealBoard(None, self.size)}
+        boards.update((category, DealBoard(category, self.size)) for category in categories)
+        self.boards = boards
+        today = date.today()
+        for board in boards.values():
+            await board.fill(today)
+
+    def upsert(self, deal: Dict[str, Any]) -> None:
+        """
+        Records a created or changed product (its ``PRODUCT_FIELDS`` values).
+        """
+        today = date.today()
+        for board in self.boards.values():
+            board.upsert(deal, today)
+
+    def discard(self, product_id: int) -> None:
+        for board in self.boards.values():
+            board.discard(product_id)
+
+    def reset(self) -> None:
+        """
+        Forgets every board; each is refilled when next asked for.
+        """
+        for board in self.boards.values():
+            board.clear()
+
+    def on_change(self, kind: str, data: Any) -> None:
+        # ChangeFeed listener. Event bodies are product_values as JSON, which
+        # encode back to the same bytes; only the expiry is compared
+        if kind in ("product.created", "product.updated"):
+            expiry = date.fromisoformat(data["offer_expiriation_date"])
+            self.upsert(dict(data, offer_expiriation_date=expiry))
+        elif kind in ("product.deleted", "product.archived"):
+            self.discard(data["id"])
+        elif kind == "products.imported":
+            self.reset()
+
+    async def top(self, k: int, category: Optional[str] = None) -> List[Dict[str, Any]]:
+        # this worker's own writes first
+        await change_feed.flush()
+        board = self.boards.get(category)
+        if board is None:
+            # only categories that exist get a board
+            if not await Product.exists(category=category):
+                return []
+            board = self.boards.setdefault(category, DealBoard(category, self.size))
+        today = date.today()
+        deals = board.top(k, today)
+        if deals is None:
+            self.refills += 1
+            await board.fill(today)
+            deals = board.top(k, today) or []
+        return deals
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "boards": len(self.boards),
+            "entries": sum(len(board) for board in self.boards.values()),
+            "refills": self.refills,
+        }
+
+
+top_deals = TopDeals()
@@ -1,40 +1,60 @@
-from fastapi import (
-    BackgroundTasks,
-    UploadFile,
-    File,
-    Form,
-    Depends,
-    HTTPException,
-    status,
-)
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
-from dotenv import dotenv_values
+import asyncio
+import logging
+import secrets
+from datetime import timedelta
+from email.message import EmailMessage
+from functools import lru_cache
+
 from pydantic import BaseModel, EmailStr
-from typing import List
-from models import User
+from tortoise import BaseDBAsyncClient, timezone
+from typing import List, Optional
+from models import EmailOutbox, User
+from settings import settings
 import jwt
 
+logger = logging.getLogger(__name__)
 
-config_crdentials = dotenv_values(".env")
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=config_crdentials["EMAIL"],
-    MAIL_PASSWORD=config_crdentials["PASSWORD"],
-    MAIL_FROM=config_crdentials["EMAIL"],
-    MAIL_PORT=587,  # Port for STARTTLS
-    MAIL_SERVER="smtp.gmail.com",
-    MAIL_STARTTLS=True,  # Use STARTTLS
-    MAIL_SSL_TLS=False,  # Disable SSL/TLS
-    USE_CREDENTIALS=True,
-    VALIDATE_CERTS=True,
-)
+@lru_cache(maxsize=None)
+def mail_config():
+    """
+    SMTP settings, built on first use so importing the app does not load the
+    mail libraries. MAIL_SERVER/MAIL_PORT/MAIL_STARTTLS/MAIL_USE_CREDENTIALS can
+    point the outbox at a local test server (e.g. aiosmtpd, from
+    requirements-dev.txt) instead of Gmail.
+    """
+    from fastapi_mail import ConnectionConfig
+
+    return ConnectionConfig(
+        MAIL_USERNAME=settings.EMAIL,
+        MAIL_PASSWORD=settings.PASSWORD,
+        MAIL_FROM=settings.EMAIL,
+        MAIL_PORT=settings.MAIL_PORT,
+        MAIL_SERVER=settings.MAIL_SERVER,
+        MAIL_STARTTLS=settings.MAIL_STARTTLS,  # Use STARTTLS
+        MAIL_SSL_TLS=False,  # Disable SSL/TLS
+        USE_CREDENTIALS=settings.MAIL_USE_CREDENTIALS,
+        VALIDATE_CERTS=True,
+    )
+
+
+# outbox dispatcher settings
+OUTBOX_BATCH_SIZE = settings.OUTBOX_BATCH_SIZE
+OUTBOX_POLL_INTERVAL = settings.OUTBOX_POLL_INTERVAL
+OUTBOX_MAX_ATTEMPTS = settings.OUTBOX_MAX_ATTEMPTS
+OUTBOX_BACKOFF = settings.OUTBOX_BACKOFF  # doubled per attempt
+OUTBOX_MAX_BACKOFF = settings.OUTBOX_MAX_BACKOFF
+OUTBOX_LEASE = 300  # seconds a claimed batch is reserved for one dispatcher
 
 
 class EmailSchema(BaseModel):
     email: List[EmailStr]
 
 
-async def send_email(email: EmailSchema, instance: User):
+def verification_email(instance: User) -> str:
+    """
+    Builds the HTML body of the verification email for a new user.
+    """
     token_data = {
         "id": instance.id,
         "email": instance.email,
@@ -42,7 +62,7 @@ async def send_email(email: EmailSchema, instance: User):
         # Ensure all keys and values are valid
     }
 
-    token = jwt.encode(token_data, config_crdentials["SECRET"], algorithm="HS256")
+    token = jwt.encode(token_data, settings.SECRET, algorithm="HS256")
 
     template = f"""
     <!DOCTYPE html>
@@ -80,12 +100,190 @@ async def send_email(email: EmailSchema, instance: User):
         </body>
     </html>
     """
-    recipient_email = str(instance.email)
-    message = MessageSchema(
-        subject="E-commerce Email Verification",
-        recipients=[recipient_email],
-        body=template,
-        subtype="html",
-    )
-    fm = FastMail(conf)
-    await fm.send_message(message)
+    return template
+
+
+async def queue_email(
+    email: EmailSchema,
+    instance: User,
+    using_db: Optional[BaseDBAsyncClient] = None,
+):
+    """
+    Queues the verification email in the outbox. The row is delivered later by
+    ``outbox_dispatcher``, so the caller never waits on the SMTP server.
+
+    Args:
+        email (EmailSchema): The recipients.
+        instance (User): The user being verified.
+        using_db (BaseDBAsyncClient, optional): Connection/transaction to write with.
+    """
+    body = verification_email(instance)
+    for recipient in email.email:
+        await EmailOutbox.create(
+            recipient=str(recipient),
+            subject="E-commerce Email Verification",
+            body=body,
+            using_db=using_db,
+        )
+    outbox_dispatcher.wake()
+
+
+class OutboxDispatcher:
+    """
+    Background task that drains the email outbox in batches, sending each
+    batch over one SMTP connection and retrying failures with exponential backoff.
+    """
+
+    def __init__(self):
+        self.id = secrets.token_hex(8)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.drain()
+            except Exception:
+                logger.exception("Email outbox dispatch failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def drain(self) -> int:
+        """
+        Sends every due email, one batch at a time.
+
+        Returns:
+            int: Number of outbox rows processed.
+        """
+        processed = 0
+        while batch := await self._claim_batch():
+            await self.deliver(batch)
+            processed += len(batch)
+        return processed
+
+    async def _claim_batch(self) -> List[EmailOutbox]:
+        now = timezone.now()
+        due = {"status__in": ["pending", "sending"], "next_attempt_at__lte": now}
+        ids = (
+            await EmailOutbox.filter(**due)
+            .order_by("id")
+            .limit(OUTBOX_BATCH_SIZE)
+            .values_list("id", flat=True)
+        )
+        if not ids:
+            return []
+        # the lease keeps other workers off these rows; a crashed sender's rows
+        # become due again once it runs out
+        await EmailOutbox.filter(id__in=ids, **due).update(
+            status="sending",
+            claimed_by=self.id,
+            next_attempt_at=now + timedelta(seconds=OUTBOX_LEASE),
+        )
+        return await EmailOutbox.filter(
+            id__in=ids, status="sending", claimed_by=self.id
+        ).order_by("id")
+
+    async def deliver(self, batch: List[EmailOutbox]) -> None:
+        import aiosmtplib  # loaded with the first batch, like mail_config
+        from pydantic import ValidationError
+
+        try:
+            conf = mail_config()
+        except ValidationError as exc:
+            # EMAIL/PASSWORD unset: back off instead of holding the lease
+            logger.error("Email outbox cannot send, SMTP settings are incomplete")
+            for row in batch:
+                await self._failed(row, exc)
+            return
+        smtp = aiosmtplib.SMTP(
+            hostname=conf.MAIL_SERVER,
+            port=conf.MAIL_PORT,
+            start_tls=conf.MAIL_STARTTLS,
+            use_tls=conf.MAIL_SSL_TLS,
+            validate_certs=conf.VALIDATE_CERTS,
+            username=conf.MAIL_USERNAME if conf.USE_CREDENTIALS else None,
+            password=conf.MAIL_PASSWORD.get_secret_value()
+            if conf.USE_CREDENTIALS
+            else None,
+        )
+        sent = []
+        try:
+            await smtp.connect()
+            for row in batch:
+                try:
+                    await smtp.send_message(self._message(row))
+                except aiosmtplib.SMTPException as exc:
+                    if not smtp.is_connected:
+                        raise
+                    # rejected by the server (e.g. SMTPRecipientsRefused); the
+                    # connection is still usable for the other rows
+                    await self._failed(row, exc)
+                else:
+                    sent.append(row.id)
+        except (aiosmtplib.SMTPException, OSError) as exc:
+            # connection lost or refused: nothing else in the batch was tried
+            for row in batch:
+                if row.id not in sent and row.status == "sending":
+                    await self._failed(row, exc)
+        finally:
+            if smtp.is_connected:
+                try:
+                    await smtp.quit()
+                except aiosmtplib.SMTPException:
+                    smtp.close()
+        if sent:
+            await EmailOutbox.filter(id__in=sent).update(
+                status="sent", sent_at=timezone.now(), claimed_by=None
+            )
+
+    @staticmethod
+    def _message(row: EmailOutbox) -> EmailMessage:
+        message = EmailMessage()
+        message["From"] = mail_config().MAIL_FROM
+        message["To"] = row.recipient
+        message["Subject"] = row.subject
+        message.set_content(row.body, subtype="html")
+        return message
+
+    @staticmethod
+    async def _failed(row: EmailOutbox, exc: Exception) -> None:
+        row.attempts += 1
+        row.last_error = str(exc)
+        row.claimed_by = None
+        if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+            row.status = "failed"
+        else:
+            row.status = "pending"
+            delay = min(OUTBOX_BACKOFF * 2 ** (row.attempts - 1), OUTBOX_MAX_BACKOFF)
+            row.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+        await row.save(
+            update_fields=[
+                "attempts",
+                "last_error",
+                "claimed_by",
+                "status",
+                "next_attempt_at",
+            ]
+        )
+
+
+outbox_dispatcher = OutboxDispatcher()
@@ -0,0 +1,273 @@
+"""
+Change feed for products and business profiles, streamed by GET /changes as
+Server-Sent Events.
+
+Writes append events to the ``change_event`` log (``ChangeEvent``), whose id
+is the sequence number every client sees, in every worker. One poller per
+worker reads new events and hands them to the connected clients, each through
+a buffer of ``FEED_CLIENT_BUFFER`` events. A client that lets its buffer fill
+up goes back to reading the log from its last event, as does a client that
+reconnects with ``Last-Event-ID``. Clients that fell behind the retained
+``FEED_BACKLOG`` events get a ``reset`` event and should reload.
+
+In-process consumers (``ChangeFeed.follow``) get the same events from the
+poller, decoded, whichever worker wrote them. The poller reads the log every
+``FEED_POLL_INTERVAL`` seconds while there are clients or consumers, so with
+the deal boards and the similar products index following it that is for the
+life of the worker: one indexed query on ``change_event`` per interval. With
+neither, it sleeps until a local event.
+"""
+
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import orjson
+
+from tortoise import BaseDBAsyncClient
+
+from catalog import encode_response
+from models import Business, ChangeEvent
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+FEED_BACKLOG = settings.FEED_BACKLOG
+FEED_CLIENT_BUFFER = settings.FEED_CLIENT_BUFFER
+FEED_POLL_INTERVAL = settings.FEED_POLL_INTERVAL
+FEED_HEARTBEAT = settings.FEED_HEARTBEAT
+
+# events read from the log per query
+FEED_BATCH_SIZE = 500
+# reconnection delay suggested to EventSource clients, in ms
+RETRY_MS = 3000
+
+
+def business_values(business: Business) -> Dict[str, Any]:
+    """
+    The fields business_pydantic serializes.
+    """
+    return {
+        name: getattr(business, name)
+        for name in Business._meta.fields_db_projection
+        if name != "owner_id"
+    }
+
+
+def _event(event_id: int, kind: str, data: str) -> bytes:
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n".encode()
+
+
+async def _latest_id() -> int:
+    ids = await ChangeEvent.all().order_by("-id").limit(1).values_list("id", flat=True)
+    return ids[0] if ids else 0
+
+
+class _Subscriber:
+    def __init__(self, size: int):
+        self.queue: "asyncio.Queue[Tuple[int, bytes]]" = asyncio.Queue(size)
+        # set by the poller when the queue was full; the client then reads
+        # what it missed from the log
+        self.overflowed = False
+
+
+class ChangeFeed:
+    """
+    Publishes change events and streams them to the connected clients.
+    """
+
+    def __init__(self, client_buffer: int = FEED_CLIENT_BUFFER):
+        self.client_buffer = client_buffer
+        # the last event handed to the clients; None while nobody listens
+        self.last_id: Optional[int] = None
+        self.overflows = 0
+        self._subscribers: Set[_Subscriber] = set()
+        # called with (kind, data) for every event, see follow
+        self._listeners: List[Callable[[str, Any], None]] = []
+        # events this worker published, and how many of them were dispatched
+        self._published = 0
+        self._dispatched = 0
+        self._dispatching = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._trimmed_at = 0
+
+    async def publish(
+        self, kind: str, data: Any, using_db: Optional[BaseDBAsyncClient] = None
+    ) -> None:
+        """
+        Appends an event. With ``using_db`` it commits with that transaction.
+        """
+        await ChangeEvent.create(
+            kind=kind, data=encode_response(data).decode(), using_db=using_db
+        )
+        self._published += 1
+        self._wake.set()
+
+    async def publish_many(self, kind: str, items: Iterable[Any]) -> None:
+        events = [ChangeEvent(kind=kind, data=encode_response(data).decode()) for data in items]
+        if events:
+            await ChangeEvent.bulk_create(events)
+            self._published += 1
+            self._wake.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def follow(self, listener: Callable[[str, Any], None]) -> None:
+        """
+        Calls ``listener(kind, data)`` for every event published from now on,
+        in every worker, in sequence order. Everything committed before this
+        returns is older than the first event the listener gets.
+        """
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+        if self.last_id is None:
+            latest = await _latest_id()
+            if self.last_id is None:
+                self.last_id = latest
+        self._wake.set()
+
+    async def flush(self) -> None:
+        """
+        Dispatches the events this worker published so far, if the poller has
+        not yet, so that a read right after a local write sees it.
+        """
+        if self._published == self._dispatched or not self._listening():
+            return
+        async with self._dispatching:
+            if self._published != self._dispatched:
+                await self._dispatch()
+
+    def _listening(self) -> bool:
+        return bool(self._subscribers or self._listeners)
+
+    async def _run(self) -> None:
+        while True:
+            # local events wake the poller at once, other workers' events are
+            # picked up every FEED_POLL_INTERVAL seconds
+            timeout = FEED_POLL_INTERVAL if self._listening() else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if not self._listening():
+                self.last_id = None
+                continue
+            try:
+                async with self._dispatching:
+                    await self._dispatch()
+            except Exception:
+                logger.exception("Reading the change feed failed")
+
+    async def _dispatch(self) -> None:
+        published = self._published
+        while self.last_id is not None:
+            rows = (
+                await ChangeEvent.filter(id__gt=self.last_id)
+                .order_by("id")
+                .limit(FEED_BATCH_SIZE)
+                .values_list("id", "kind", "data")
+            )
+            for event_id, kind, data in rows:
+                for listener in self._listeners:
+                    try:
+                        listener(kind, orjson.loads(data))
+                    except Exception:
+                        logger.exception("Change feed listener failed on event %s", event_id)
+                event = (event_id, _event(event_id, kind, data))
+                for subscriber in self._subscribers:
+                    if subscriber.overflowed:
+                        continue
+                    try:
+                        subscriber.queue.put_nowait(event)
+                    except asyncio.QueueFull:
+                        subscriber.overflowed = True
+                        self.overflows += 1
+            if rows:
+                self.last_id = rows[-1][0]
+            if len(rows) < FEED_BATCH_SIZE:
+                break
+        self._dispatched = published
+        # every worker trims now and then; the log only needs the backlog
+        if self.last_id and self.last_id - self._trimmed_at >= 1000:
+            self._trimmed_at = self.last_id
+            await ChangeEvent.filter(id__lte=self.last_id - FEED_BACKLOG).delete()
+
+    async def _subscribe(self) -> _Subscriber:
+        subscriber = _Subscriber(self.client_buffer)
+        self._subscribers.add(subscriber)
+        if self.last_id is None:
+            # the poller starts from here; anything older is read from the log
+            latest = await _latest_id()
+            if self.last_id is None:
+                self.last_id = latest
+        self._wake.set()
+        return subscriber
+
+    async def stream(self, after: Optional[int] = None) -> AsyncIterator[bytes]:
+        """
+        The events after sequence number ``after`` (from now on when None),
+        as an endless ``text/event-stream`` body.
+        """
+        subscriber = await self._subscribe()
+        try:
+            position = await _latest_id() if after is None else after
+            yield f"retry: {RETRY_MS}\n\n".encode()
+            while True:
+                # catch up from the log
+                first = True
+                while True:
+                    rows = (
+                        await ChangeEvent.filter(id__gt=position)
+                        .order_by("id")
+                        .limit(FEED_BATCH_SIZE)
+                        .values_list("id", "kind", "data")
+                    )
+                    if first and rows and rows[0][0] > position + 1:
+                        # the events in between were trimmed
+                        yield _event(rows[0][0] - 1, "reset", "{}")
+                    first = False
+                    for event_id, kind, data in rows:
+                        yield _event(event_id, kind, data)
+                        position = event_id
+                    if len(rows) < FEED_BATCH_SIZE:
+                        break
+
+                # then follow the poller until the buffer overflows
+                while not (subscriber.overflowed and subscriber.queue.empty()):
+                    try:
+                        event_id, event = await asyncio.wait_for(
+                            subscriber.queue.get(), FEED_HEARTBEAT
+                        )
+                    except asyncio.TimeoutError:
+                        yield b": keep-alive\n\n"
+                        continue
+                    if event_id > position:
+                        yield event
+                        position = event_id
+                subscriber.overflowed = False
+        finally:
+            self._subscribers.discard(subscriber)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "clients": len(self._subscribers),
+            "listeners": len(self._listeners),
+            "last_id": self.last_id,
+            "overflows": self.overflows,
+        }
+
+
+change_feed = ChangeFeed()
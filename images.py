@@ -0,0 +1,470 @@
+import asyncio
+import hashlib
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import aiofiles
+from fastapi import HTTPException, UploadFile, status
+from fastapi.staticfiles import StaticFiles
+from PIL import Image, ImageOps, UnidentifiedImageError
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+from tortoise import Tortoise, run_async
+
+from database import tortoise_config
+from models import ArchivedProduct, Business, Product
+from settings import settings
+
+PROFILE_IMAGES = "./static/images/profile_images"
+PRODUCT_IMAGES = "./static/images/product_images"
+
+ALLOWED_EXTENSIONS = ["jpg", "jpeg", "png", "webp"]
+PIL_FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}
+
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = settings.MAX_UPLOAD_BYTES
+
+# rendition sizes
+IMAGE_SIZE = (400, 400)
+THUMBNAIL_SIZE = (120, 120)
+
+# images are stored as <dir>/ab/cd/<sha256 of the upload>.<ext>; the name
+# never changes for a given content so it can be cached forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+STORED_IMAGE = re.compile(r"(?:[0-9a-f]{2}/[0-9a-f]{2}/)?([0-9a-f]{20}|[0-9a-f]{64})(?:_thumb)?\.\w+$")
+CONTENT_ADDRESSED = re.compile(r"images/\w+/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64}(?:_thumb)?\.\w+)$")
+
+# resized variants rendered on request (GET /images/...), kept in a
+# size-bounded LRU directory outside static/
+IMAGE_CACHE_DIR = settings.IMAGE_CACHE_DIR
+IMAGE_CACHE_BYTES = settings.IMAGE_CACHE_BYTES
+MAX_VARIANT_SIZE = settings.MAX_VARIANT_SIZE
+VARIANT_FORMATS = {"jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}
+# variants of files that may be replaced under the same name (the bundled
+# defaults) are cached for a day instead of forever
+MUTABLE_CACHE_CONTROL = "public, max-age=86400"
+# sources that failed to decode, remembered so they are not decoded again
+UNDECODABLE_ENTRIES = 1024
+
+# uploads are streamed here, and renditions written here before they are
+# moved into place, so /static never serves a partial file
+IMAGE_UPLOAD_DIR = settings.IMAGE_UPLOAD_DIR
+
+# files younger than this are never collected, so an upload whose row is not
+# saved yet survives a concurrent GC run
+IMAGE_GC_GRACE = settings.IMAGE_GC_GRACE
+
+# decoding and resizing happen here, never on the event loop
+image_executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_WORKERS,
+    thread_name_prefix="images",
+)
+
+
+def image_extension(filename: str) -> str:
+    extension = filename.split(".")[-1].lower()
+    if extension not in ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only image files are allowed.",
+        )
+    return extension
+
+
+def shard_path(digest: str, filename: str) -> str:
+    return f"{digest[:2]}/{digest[2:4]}/{filename}"
+
+
+def atomic_write(path: str, data: bytes, tmp_dir: Optional[str] = None) -> None:
+    """
+    Writes a file so readers only ever see the old or the complete new content.
+    The data is written to a temporary file in ``tmp_dir`` (default: next to
+    ``path``), which must be on the same filesystem.
+    """
+    tmp_name = f"{os.path.basename(path)}.{secrets.token_hex(4)}.tmp"
+    tmp_path = os.path.join(tmp_dir or os.path.dirname(path), tmp_name)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def encode_image(image: Image.Image, image_format: str) -> bytes:
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def rendition_names(digest: str, extension: str) -> Dict[str, str]:
+    names = {
+        "original": f"{digest}.{extension}",
+        "thumbnail": f"{digest}_thumb.{extension}",
+    }
+    if extension != "webp":
+        names["webp"] = f"{digest}.webp"
+    return {name: shard_path(digest, filename) for name, filename in names.items()}
+
+
+def render_renditions(
+    upload_path: str, directory: str, digest: str, extension: str
+) -> Dict[str, str]:
+    """
+    Decodes the upload once and writes every rendition of it, unless an
+    identical upload has already been stored.
+
+    Returns:
+        dict: Rendition name -> path relative to ``directory``.
+    """
+    names = rendition_names(digest, extension)
+    try:
+        # an identical upload is stored already; touch it, since
+        # collect_orphans ages unreferenced files by mtime and the row that
+        # links it again may not be written yet
+        for path in names.values():
+            os.utime(os.path.join(directory, path))
+        return names
+    except FileNotFoundError:
+        pass
+
+    with open(upload_path, "rb") as f:
+        data = f.read()
+    try:
+        image = Image.open(BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="The uploaded file is not a valid image.",
+        ) from exc
+
+    image = image.resize(IMAGE_SIZE)
+    renditions = {
+        "original": (image, PIL_FORMATS[extension]),
+        "thumbnail": (image.resize(THUMBNAIL_SIZE), PIL_FORMATS[extension]),
+        "webp": (image, "WEBP"),
+    }
+    os.makedirs(os.path.join(directory, os.path.dirname(names["original"])), exist_ok=True)
+    for name, path in names.items():
+        rendition, image_format = renditions[name]
+        atomic_write(
+            os.path.join(directory, path),
+            encode_image(rendition, image_format),
+            IMAGE_UPLOAD_DIR,
+        )
+    return names
+
+
+async def ingest_image(file: UploadFile, directory: str) -> Dict[str, str]:
+    """
+    Streams an upload to a temporary file in ``IMAGE_UPLOAD_DIR`` while
+    hashing it, then decodes, resizes and writes its renditions in the image
+    worker pool. Identical uploads map to the same files and are only
+    rendered once.
+
+    Args:
+        file (UploadFile): The uploaded image.
+        directory (str): Where the renditions are stored.
+
+    Returns:
+        dict: Rendition name -> path relative to ``directory``; "original" is
+        the 400x400 image.
+    """
+    extension = image_extension(file.filename)
+    os.makedirs(IMAGE_UPLOAD_DIR, exist_ok=True)
+    upload_path = os.path.join(IMAGE_UPLOAD_DIR, f"{secrets.token_hex(10)}.upload")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(upload_path, "wb") as f:
+            while chunk := await file.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail="The uploaded file is too large.",
+                    )
+                digest.update(chunk)
+                await f.write(chunk)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            image_executor,
+            render_renditions,
+            upload_path,
+            directory,
+            digest.hexdigest(),
+            extension,
+        )
+    finally:
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+
+
+class ImageFiles(StaticFiles):
+    """
+    StaticFiles serving content-addressed images with a far-future
+    ``Cache-Control: immutable`` and their file name as a strong ETag.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        match = CONTENT_ADDRESSED.search(str(full_path).replace(os.sep, "/"))
+        if match:
+            response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+            response.headers["etag"] = f'"{match.group(1)}"'
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def render_variant(source: str, target: str, size: Tuple[int, int], image_format: str) -> int:
+    """
+    Scales and crops ``source`` to exactly ``size`` and writes it to
+    ``target``.
+
+    Raises:
+        HTTPException: 404 if ``source`` is not a decodable image.
+
+    Returns:
+        int: Size of the written file in bytes.
+    """
+    try:
+        with Image.open(source) as image:
+            variant = ImageOps.fit(image, size, Image.LANCZOS)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as exc:
+        raise _undecodable() from exc
+    data = encode_image(variant, image_format)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    atomic_write(target, data)
+    return len(data)
+
+
+def _undecodable() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND, detail="Image cannot be decoded."
+    )
+
+
+class ImageVariants:
+    """
+    On-disk LRU cache of resized images, bounded by total size. Variants are
+    rendered in the image worker pool on first request; concurrent requests
+    for the same variant wait for the same render.
+
+    Args:
+        directory (str): Where the variants are stored.
+        max_bytes (int): Total size of the stored variants before eviction.
+    """
+
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.evictions = 0
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._rendering: Dict[str, asyncio.Future] = {}
+        # "<source>:<size>:<mtime>" of sources that failed to decode; a
+        # replaced file gets another try
+        self._undecodable: "OrderedDict[str, None]" = OrderedDict()
+        self._loaded: Optional[asyncio.Future] = None
+
+    def _scan(self) -> list:
+        # variants left by earlier runs, least recently written first
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                full_path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    os.remove(full_path)
+                    continue
+                stat = os.stat(full_path)
+                files.append((stat.st_mtime, os.path.relpath(full_path, self.directory), stat.st_size))
+        return sorted(files)
+
+    async def _load(self) -> None:
+        loop = asyncio.get_running_loop()
+        for _, path, size in await loop.run_in_executor(image_executor, self._scan):
+            self._files[path] = size
+            self.size += size
+        self._evict()
+
+    async def get(
+        self, directory: str, path: str, size: Tuple[int, int], image_format: str
+    ) -> Tuple[str, str]:
+        """
+        The variant of image ``path`` in ``directory``, rendering it if needed.
+
+        Raises:
+            HTTPException: 404 if there is no such image or it cannot be
+                decoded.
+
+        Returns:
+            tuple: Path of the variant file and its key, usable as an ETag.
+        """
+        if path.startswith("/") or ".." in path.split("/") or not os.path.isfile(
+            source := os.path.join(directory, path)
+        ):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found.")
+        if self._loaded is None:
+            self._loaded = asyncio.ensure_future(self._load())
+        await asyncio.shield(self._loaded)
+
+        # the source's size and mtime are part of the key, so a replaced file
+        # never serves an old variant
+        stat = os.stat(source)
+        source_key = f"{source}:{stat.st_size}:{stat.st_mtime_ns}"
+        if source_key in self._undecodable:
+            self._undecodable.move_to_end(source_key)
+            raise _undecodable()
+        key = hashlib.sha1(f"{source_key}:{size}:{image_format}".encode()).hexdigest()
+        extension = "jpg" if image_format == "JPEG" else image_format.lower()
+        variant = shard_path(key, f"{key}.{extension}")
+        full_path = os.path.join(self.directory, variant)
+        if variant in self._files and os.path.exists(full_path):
+            self._files.move_to_end(variant)
+            self.hits += 1
+            return full_path, key
+
+        self.misses += 1
+        render = self._rendering.get(variant)
+        if render is None:
+            render = asyncio.ensure_future(
+                self._render(source, source_key, variant, full_path, size, image_format)
+            )
+            self._rendering[variant] = render
+            render.add_done_callback(lambda _: self._rendering.pop(variant, None))
+        # a client that goes away does not cancel the render others wait for
+        await asyncio.shield(render)
+        return full_path, key
+
+    async def _render(
+        self,
+        source: str,
+        source_key: str,
+        variant: str,
+        full_path: str,
+        size: Tuple[int, int],
+        image_format: str,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            written = await loop.run_in_executor(
+                image_executor, render_variant, source, full_path, size, image_format
+            )
+        except HTTPException:
+            self._undecodable[source_key] = None
+            if len(self._undecodable) > UNDECODABLE_ENTRIES:
+                self._undecodable.popitem(last=False)
+            raise
+        self.renders += 1
+        self.size += written - self._files.pop(variant, 0)
+        self._files[variant] = written
+        self._evict()
+
+    def _evict(self) -> None:
+        # the newest variant stays even if it alone exceeds the bound
+        while self.size > self.max_bytes and len(self._files) > 1:
+            path, size = self._files.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, path))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        lookups = self.hits + self.misses
+        return {
+            "files": len(self._files),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "renders": self.renders,
+            "evictions": self.evictions,
+            "undecodable": len(self._undecodable),
+        }
+
+
+image_variants = ImageVariants()
+
+
+def stored_images(directory: str) -> Iterator[str]:
+    """
+    Yields the paths, relative to ``directory``, of every uploaded image file
+    (content-addressed or legacy random names). Bundled defaults are skipped.
+    """
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            path = os.path.relpath(os.path.join(root, filename), directory)
+            path = path.replace(os.sep, "/")
+            if STORED_IMAGE.fullmatch(path):
+                yield path
+
+
+def image_key(path: str) -> str:
+    # every rendition of an upload shares the hash (or legacy token) in its name
+    return STORED_IMAGE.fullmatch(path).group(1)
+
+
+def collect_orphans(directory: str, referenced: Set[str], grace: float = IMAGE_GC_GRACE) -> int:
+    """
+    Deletes the renditions of images no row references anymore.
+
+    Returns:
+        int: Number of files deleted.
+    """
+    keys = {image_key(name) for name in referenced if name and STORED_IMAGE.fullmatch(name)}
+    cutoff = time.time() - grace
+    deleted = 0
+    for path in stored_images(directory):
+        full_path = os.path.join(directory, path)
+        if image_key(path) in keys or os.path.getmtime(full_path) > cutoff:
+            continue
+        os.remove(full_path)
+        deleted += 1
+    return deleted
+
+
+async def collect_orphan_images(grace: float = IMAGE_GC_GRACE) -> Dict[str, int]:
+    """
+    Deletes logo and product image files that no ``Business.logo``,
+    ``Product.product_image`` or ``ArchivedProduct.product_image`` references.
+
+    Returns:
+        dict: Files deleted per image directory.
+    """
+    logos = set(await Business.all().values_list("logo", flat=True))
+    product_images = set(await Product.all().values_list("product_image", flat=True))
+    product_images |= set(
+        await ArchivedProduct.all().values_list("product_image", flat=True)
+    )
+    loop = asyncio.get_running_loop()
+    return {
+        "profile_images": await loop.run_in_executor(
+            image_executor, collect_orphans, PROFILE_IMAGES, logos, grace
+        ),
+        "product_images": await loop.run_in_executor(
+            image_executor, collect_orphans, PRODUCT_IMAGES, product_images, grace
+        ),
+    }
+
+
+async def _collect() -> None:
+    await Tortoise.init(config=tortoise_config())
+    deleted = await collect_orphan_images()
+    print(f"Deleted orphaned images: {deleted}")
+
+
+if __name__ == "__main__":
+    run_async(_collect())
@@ -1,5 +1,17 @@
-from fastapi import FastAPI, Request, status, HTTPException
+from fastapi import FastAPI, Request, status, HTTPException, Query, Depends, Body
+from datetime import date
+
+from tortoise import Tortoise
+from tortoise.exceptions import DoesNotExist
+from tortoise.expressions import F
 from tortoise.contrib.fastapi import register_tortoise
+from database import (
+    add_missing_columns,
+    schema_version,
+    store_schema_version,
+    stored_schema_version,
+    tortoise_config,
+)
 from tortoise.contrib.pydantic import pydantic_queryset_creator
 from models import *
 
@@ -9,18 +21,44 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
 
 # signals
-from tortoise.signals import post_save
-from typing import List, Optional, Type
+from tortoise.signals import post_save, post_delete
+from typing import List, Literal, Optional, Type
 from tortoise import BaseDBAsyncClient
 
 
 from emails import *
 
 # response class
-from fastapi.responses import HTMLResponse
+from fastapi.responses import (
+    HTMLResponse,
+    PlainTextResponse,
+    Response,
+    FileResponse,
+    StreamingResponse,
+)
+
+# request metrics
+from metrics import (
+    MetricsMiddleware,
+    instrument_tortoise,
+    register_cache,
+    register_stats,
+    render_metrics,
+)
+
+# catalog listing and search
+from cache import CachedResponse
+from catalog import *
+from search import *
+from bulk import ProductChange, export_products_csv, import_products, update_products
+from archive import offer_sweeper, restore_product
+from deals import DEALS_MAX_K, top_deals
+from feed import business_values, change_feed
+from similar import SIMILAR_MAX_K, similar_products
+from writes import delete_owned_product, update_owned_business, update_owned_product
 
 import jwt
-from dotenv import dotenv_values
+from settings import settings
 
 # templates
 from fastapi.templating import Jinja2Templates
@@ -28,22 +66,27 @@ from fastapi.templating import Jinja2Templates
 
 # image upload
 from fastapi import UploadFile, File
-from fastapi.staticfiles import StaticFiles
-from PIL import Image
-from io import BytesIO
-from typing import Optional
-import secrets
-
-config_credentials = dotenv_values(".env")
-
+from images import *
 
 app = FastAPI()
 
+# per-route latency, query counts and Server-Timing, exported on /metrics
+instrument_tortoise()
+app.add_middleware(MetricsMiddleware)
+register_cache("token", token_cache)
+register_cache("user", user_cache)
+register_cache("response", response_cache)
+register_stats("offer_sweeper", "Expired offers moved to the archive.", offer_sweeper.stats)
+register_stats("top_deals", "In-memory top deals boards.", top_deals.stats)
+register_stats("change_feed", "Clients and events of the /changes feed.", change_feed.stats)
+register_stats("similar_products", "Feature matrix of /product/{id}/similar.", similar_products.stats)
+register_cache("image_variants", image_variants)
+
 
 oath2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # static file setup config
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", ImageFiles(directory="static"), name="static")
 
 
 # token generator configuration
@@ -62,10 +105,18 @@ async def generate_token(request_form: OAuth2PasswordRequestForm = Depends()):
 # current user details
 async def get_current_user(token: str = Depends(oath2_scheme)):
     try:
-        payload = jwt.decode(token, config_credentials["SECRET"], algorithms=["HS256"])
-        user_id = payload["id"]
-        user = await User.get(id=user_id)
-        await user.save()
+        user_id = token_cache.get(token)
+        if user_id is None:
+            payload = jwt.decode(
+                token, settings.SECRET, algorithms=["HS256"]
+            )
+            user_id = payload["id"]
+            token_cache.set(token, user_id)
+        # read-only path: cached row, invalidated by the User signals below
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await User.get(id=user_id)
+            user_cache.set(user_id, user)
         return user
     except jwt.exceptions.InvalidTokenError as exc:
         raise HTTPException(
@@ -103,16 +154,63 @@ async def user_post_save(
     using_db: "Optional[BaseDBAsyncClient]",
     update_fields: List[str],
 ) -> None:
+    user_cache.pop(instance.id)
     if created:
         business_obj = await Business.create(
             business_name=instance.username, owner=instance
         )
         await business_pydantic.from_tortoise_orm(business_obj)
-        # send email to user #Note
-        await send_email(EmailSchema(email=[instance.email]), instance)
+        # queue the verification email; outbox_dispatcher sends it
+        await queue_email(EmailSchema(email=[instance.email]), instance, using_db)
     print(f"User {instance.username} called successfully.")
 
 
+@post_delete(User)
+async def user_post_delete(
+    sender: Type[User],
+    instance: User,
+    using_db: "Optional[BaseDBAsyncClient]",
+) -> None:
+    user_cache.pop(instance.id)
+
+
+# change feed signals; writes that bypass Model.save (the conditional UPDATEs
+# in writes.py, bulk updates) publish their events in the handlers
+@post_save(Business)
+async def business_post_save(
+    sender: Type[Business],
+    instance: Business,
+    created: bool,
+    using_db: "Optional[BaseDBAsyncClient]",
+    update_fields: List[str],
+) -> None:
+    kind = "business.created" if created else "business.updated"
+    await change_feed.publish(kind, business_values(instance), using_db)
+
+
+@post_save(Product)
+async def product_post_save(
+    sender: Type[Product],
+    instance: Product,
+    created: bool,
+    using_db: "Optional[BaseDBAsyncClient]",
+    update_fields: List[str],
+) -> None:
+    kind = "product.created" if created else "product.updated"
+    await change_feed.publish(kind, product_values(instance), using_db)
+
+
+@post_delete(Product)
+async def product_post_delete(
+    sender: Type[Product],
+    instance: Product,
+    using_db: "Optional[BaseDBAsyncClient]",
+) -> None:
+    await change_feed.publish(
+        "product.deleted", {"id": instance.id, "business_id": instance.business_id}, using_db
+    )
+
+
 # user registration
 @app.post("/registration")
 async def user_registration(user: user_pydanticIn):
@@ -164,42 +262,34 @@ async def root():
     return {"message": "Hello World"}
 
 
+# Prometheus scrape endpoint
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 # business image upload
 @app.post("/uploadfile/profile")
 async def create_upload_file(
     file: UploadFile = File(...), user: user_pydantic = Depends(get_current_user)
 ):
-    FILEPATH = "./static/images/profile_images"
-    filename = file.filename
-    extension = filename.split(".")[-1]
-
-    if extension not in ["jpg", "jpeg", "png", "webp"]:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Only image files are allowed.",
-        )
-    token_name = secrets.token_hex(10) + "." + extension
-    path = f"{FILEPATH}/{token_name}"
-    file_content = await file.read()
-
-    with open(path, "wb") as f:
-        f.write(file_content)
-
-    # Pillow resize image
-    image = Image.open(path)
-    image = image.resize((400, 400))
-    image.save(path)
-
-    f.close()
-
+    image_extension(file.filename)
     business = await Business.get(owner=user)
     owner = await business.owner
 
-    image_url = "localhost:8000/static/images/profile_images/" + token_name
-
     if owner.id == user.id:
+        renditions = await ingest_image(file, PROFILE_IMAGES)
+        token_name = renditions["original"]
+        image_url = "localhost:8000/static/images/profile_images/" + token_name
+        await Business.filter(id=business.id).update(
+            logo=token_name, version=F("version") + 1
+        )
         business.logo = token_name
-        await business.save()
+        business.version += 1
+        await change_feed.publish("business.updated", business_values(business))
+        await response_cache.invalidate(f"business:{business.id}")
         return {"status": "ok", "data": f"{image_url}"}
 
     raise HTTPException(404, detail="You are not the owner of this business.")
@@ -212,36 +302,24 @@ async def upload_product_image(
     file: UploadFile = File(...),
     user: user_pydantic = Depends(get_current_user),
 ):
-    FILEPATH = "./static/images/product_images"
-    filename = file.filename
-    extension = filename.split(".")[-1]
-
-    if extension not in ["jpg", "jpeg", "png", "webp"]:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Only image files are allowed.",
-        )
-    token_name = secrets.token_hex(10) + "." + extension
-    path = f"{FILEPATH}/{token_name}"
-    file_content = await file.read()
-
-    with open(path, "wb") as f:
-        f.write(file_content)
-
-    # resize image
-    image = Image.open(path)
-    image = image.resize((400, 400))
-    image.save(path)
-
-    f.close()
-
-    product = await Product.get(id=product_id)
-    business = await product.business
-    owner = await business.owner
+    image_extension(file.filename)
+    # archived offers (see archive.py) keep their image too
+    product = await get_product_with_business(product_id, include_archived=True)
+    owner = product.business.owner
 
     if owner == user:
+        renditions = await ingest_image(file, PRODUCT_IMAGES)
+        token_name = renditions["original"]
+        await type(product).filter(id=product.id).update(
+            product_image=token_name, version=F("version") + 1
+        )
         product.product_image = token_name
-        await product.save()
+        product.version += 1
+        if isinstance(product, Product):
+            await change_feed.publish("product.updated", product_values(product))
+        await response_cache.invalidate(
+            "products", f"product:{product.id}", f"storefront:{product.business_id}"
+        )
         return {
             "status": "ok",
             "data": f"localhost:8000/static/images/product_images/{token_name}",
@@ -249,27 +327,56 @@ async def upload_product_image(
     raise HTTPException(404, detail="You are not the owner of this product.")
 
 
+# resized copies of stored images, e.g. 120x120 WebP thumbnails for listing
+# grids, rendered on first request and kept in an LRU directory
+@app.get("/images/{folder}/{path:path}")
+async def get_image_variant(
+    folder: Literal["profile_images", "product_images"],
+    path: str,
+    request: Request,
+    w: int = Query(..., ge=1, le=MAX_VARIANT_SIZE),
+    h: int = Query(..., ge=1, le=MAX_VARIANT_SIZE),
+    format: Optional[str] = Query(None, pattern="^(jpeg|png|webp)$"),
+):
+    directory = PROFILE_IMAGES if folder == "profile_images" else PRODUCT_IMAGES
+    image_format = VARIANT_FORMATS[format] if format else PIL_FORMATS.get(
+        path.rsplit(".", 1)[-1].lower(), "JPEG"
+    )
+    full_path, key = await image_variants.get(directory, path, (w, h), image_format)
+    headers = {
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL
+        if CONTENT_ADDRESSED.search(f"images/{folder}/{path}")
+        else MUTABLE_CACHE_CONTROL,
+        "ETag": f'"{key}"',
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(
+        full_path, media_type=f"image/{image_format.lower()}", headers=headers
+    )
+
+
 # business update request
 @app.put("/business/{business_id}")
 async def update_business(
     business_id: int,
     updated_business_info: business_pydanticIn,
+    request: Request,
+    http_response: Response,
     user: user_pydantic = Depends(get_current_user),
 ):
-    business = await Business.get(id=business_id)
-    owner = await business.owner
-
-    if owner == user:
-        updated_business_info = updated_business_info.dict(exclude_unset=True)
-        business = await business.update_from_dict(updated_business_info)
-        await business.save()
-        response = await business_pydantic.from_tortoise_orm(business)
-        return {"status": "ok", "data": response}
-    raise HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Not authenticated to perform this action.",
-        headers={"WWW-Authenticate": "Bearer"},
+    # one conditional UPDATE; a stale If-Match ETag gets 412
+    business = await update_owned_business(
+        business_id,
+        user.id,
+        updated_business_info.dict(exclude_unset=True),
+        request.headers.get("if-match"),
     )
+    await response_cache.invalidate(f"business:{business.id}")
+    await change_feed.publish("business.updated", business_values(business))
+    http_response.headers["ETag"] = business_etag(business)
+    response = await business_pydantic.from_tortoise_orm(business)
+    return {"status": "ok", "data": response}
 
 
 # Product CRUD methods
@@ -288,6 +395,9 @@ async def create_new_product(
         product_obj = await Product.create(
             **product_info, business=user
         )  # product created and linked to the business and saved in the database
+        await response_cache.invalidate(
+            "products", f"storefront:{product_obj.business_id}"
+        )
         new_product = await product_pydantic.from_tortoise_orm(
             product_obj
         )  # product to be sent to frontend
@@ -298,92 +408,353 @@ async def create_new_product(
     )
 
 
+# seller dashboards: many products with their businesses in one query
+@app.get("/products")
+async def get_products_by_ids(ids: str = Query(..., pattern=r"^\d+(,\d+)*$")):
+    product_ids = list(dict.fromkeys(int(product_id) for product_id in ids.split(",")))
+    if len(product_ids) > MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_PAGE_SIZE} ids per request.",
+        )
+    products = {
+        product.id: product
+        for product in await Product.filter(id__in=product_ids).select_related(
+            "business__owner"
+        )
+    }
+    data = {
+        "status": "ok",
+        "data": [product_detail(products[i]) for i in product_ids if i in products],
+        "missing": [i for i in product_ids if i not in products],
+    }
+    return Response(encode_response(data), media_type="application/json")
+
+
+# price and description changes for many products of the current user, all
+# or nothing
+@app.patch("/products")
+async def update_products_batch(
+    changes: List[ProductChange] = Body(..., min_length=1, max_length=MAX_PAGE_SIZE),
+    user: user_pydantic = Depends(get_current_user),
+):
+    products = await update_products(user.id, changes)
+    await change_feed.publish_many(
+        "product.updated", [product_values(product) for product in products]
+    )
+    await response_cache.invalidate(
+        "products",
+        *(f"product:{product.id}" for product in products),
+        *{f"storefront:{product.business_id}" for product in products},
+    )
+    data = {"status": "ok", "data": [product_values(product) for product in products]}
+    return Response(encode_response(data), media_type="application/json")
+
+
+# bulk product import, CSV (text/csv or ?format=csv) or NDJSON
+@app.post("/products/import")
+async def import_product_file(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    user: user_pydantic = Depends(get_current_user),
+):
+    business = await Business.get(owner=user)
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if content_type.startswith("text/csv") else "ndjson"
+    report = await import_products(business, request.stream(), format)
+    if report["created"]:
+        await response_cache.invalidate("products", f"storefront:{business.id}")
+        await change_feed.publish(
+            "products.imported", {"business_id": business.id, "created": report["created"]}
+        )
+    return {"status": "ok", "data": report}
+
+
+@app.get("/business/{business_id}/products/export")
+async def export_business_products(
+    business_id: int,
+    format: str = Query("ndjson", pattern="^(csv|ndjson)$"),
+    user: user_pydantic = Depends(get_current_user),
+):
+    business = await Business.get(id=business_id).select_related("owner")
+    if business.owner != user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated to perform this action.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    queryset = Product.filter(business_id=business_id)
+    if format == "csv":
+        return StreamingResponse(export_products_csv(queryset), media_type="text/csv")
+    return StreamingResponse(
+        stream_products(queryset), media_type="application/x-ndjson"
+    )
+
+
+# storefront: one business's products, newest id last, and its summary
+@app.get("/business/{business_id}/products")
+async def get_business_products(
+    business_id: int,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+):
+    cache_key = ("business_products", business_id, limit, after)
+    cached = await response_cache.get(cache_key)
+    if cached is None:
+        generation = response_cache.generation
+        if not await Business.exists(id=business_id):
+            raise HTTPException(status_code=404, detail="Business not found.")
+        queryset = Product.filter(business_id=business_id)
+        response, next_cursor = await product_page(queryset, limit, after)
+        data = {"status": "ok", "data": response, "next_cursor": next_cursor}
+        cached = CachedResponse(encode_response(data), {})
+        response_cache.set(cache_key, cached, [f"storefront:{business_id}"], generation)
+    return Response(cached.body, media_type="application/json")
+
+
+@app.get("/business/{business_id}/summary")
+async def get_business_summary(business_id: int):
+    cache_key = ("business_summary", business_id)
+    cached = await response_cache.get(cache_key)
+    if cached is None:
+        generation = response_cache.generation
+        if not await Business.exists(id=business_id):
+            raise HTTPException(status_code=404, detail="Business not found.")
+        data = {"status": "ok", "data": await storefront_summary(business_id)}
+        cached = CachedResponse(encode_response(data), {})
+        response_cache.set(cache_key, cached, [f"storefront:{business_id}"], generation)
+    return Response(cached.body, media_type="application/json")
+
+
 @app.get("/product")
-async def get_all_products():
-    response = await product_pydantic.from_queryset(Product.all())
-    return {"status": "ok", "data": response}
+async def get_all_products(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+    stream: bool = False,
+    facets: bool = False,
+    include_archived: bool = False,
+    filters: ProductFilters = Depends(),
+):
+    queryset, key = filter_products(Product.all(), filters)
+    # expired offers are only listed on request, see archive.py
+    archived = (
+        filter_products(ArchivedProduct.all(), filters)[0] if include_archived else None
+    )
+    # stream=true returns the whole (filtered) catalog as NDJSON, read in batches
+    if stream:
+        return StreamingResponse(
+            stream_products(queryset, after, key, archived=archived),
+            media_type="application/x-ndjson",
+        )
+
+    cache_key = ("product", tuple(sorted(request.query_params.multi_items())))
+    if filters.active:
+        # "active" is relative to today, which no write tag covers
+        cache_key += (date.today(),)
+    cached = await response_cache.get(cache_key)
+    if cached is None:
+        generation = response_cache.generation
+        response, next_cursor = await product_page(
+            queryset, limit, after, key, archived
+        )
+        data = {"status": "ok", "data": response, "next_cursor": next_cursor}
+        if facets:
+            data["facets"] = await product_facets(
+                queryset, *([archived] if archived is not None else [])
+            )
+        cached = CachedResponse(encode_response(data), {})
+        response_cache.set(cache_key, cached, ["products"], generation)
+    return Response(cached.body, media_type="application/json")
+
+
+# change feed as Server-Sent Events; a reconnecting client resumes after the
+# Last-Event-ID its EventSource sends (or ?after=)
+@app.get("/changes")
+async def stream_changes(request: Request, after: Optional[int] = Query(None, ge=0)):
+    last_event_id = request.headers.get("last-event-id", "")
+    if after is None and last_event_id.isdigit():
+        after = int(last_event_id)
+    return StreamingResponse(
+        change_feed.stream(after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# best current discounts, from the boards in deals.py; no catalog scan
+@app.get("/deals/top")
+async def get_top_deals(
+    k: int = Query(10, ge=1, le=DEALS_MAX_K), category: Optional[str] = None
+):
+    data = {"status": "ok", "data": await top_deals.top(k, category)}
+    return Response(encode_response(data), media_type="application/json")
+
+
+# declared before /product/{product_id} so "search" is not taken as an id
+@app.get("/product/search")
+async def search_product(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+):
+    response, next_cursor = await search_products(q, limit, after)
+    data = {"status": "ok", "data": response, "next_cursor": next_cursor}
+    return Response(encode_response(data), media_type="application/json")
+
+
+# live offers most like a product by name, description, category and price
+# band: one matrix product over the whole catalog, see similar.py
+@app.get("/product/{product_id}/similar")
+async def get_similar_products(
+    product_id: int, k: int = Query(10, ge=1, le=SIMILAR_MAX_K)
+):
+    ids = await similar_products.similar(product_id, k)
+    rows = {row["id"]: row for row in await Product.filter(id__in=ids).values(*PRODUCT_FIELDS)}
+    # a product deleted since the index saw it is left out
+    data = {"status": "ok", "data": [rows[i] for i in ids if i in rows]}
+    return Response(encode_response(data), media_type="application/json")
 
 
 @app.get("/product/{product_id}")
-async def get_product_by_id(product_id: int):
-    product = await Product.get(id=product_id)
-    business = await product.business
-    owner = await business.owner
-    response = await product_pydantic.from_tortoise_orm(product)
+async def get_product_by_id(product_id: int, request: Request):
+    cache_key = ("product_detail", product_id)
+    cached = await response_cache.get(cache_key)
+    if cached is None:
+        generation = response_cache.generation
+        # an expired offer keeps its page after the sweeper archived it
+        product = await get_product_with_business(product_id, include_archived=True)
+        data = {"status": "ok", "data": product_detail(product)}
+        cached = CachedResponse(encode_response(data), {"ETag": product_etag(product)})
+        response_cache.set(
+            cache_key,
+            cached,
+            [f"product:{product.id}", f"business:{product.business_id}"],
+            generation,
+        )
 
-    return {
-        "status": "ok",
-        "data": {
-            "product_details": response,
-            "business_details": {
-                "name": business.business_name,
-                "city": business.city,
-                "region": business.region,
-                "business_description": business.business_description,
-                "logo": f"localhost:8000/static/images/profile_images/{business.logo}",
-                "owner_id": owner.id,
-                "business_id": business.id,
-                "email": owner.email,
-                "joined_date": owner.join_date.strftime("%b-%m-%Y"),
-            },
-        },
-    }
+    # conditional GET: answer from the ETag alone when the client is up to date
+    etag = cached.headers["ETag"]
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(cached.body, media_type="application/json", headers=cached.headers)
 
 
 @app.put("/product/{product_id}")
 async def update_product(
     product_id: int,
     updated_product_info: product_pydanticIn,
+    request: Request,
+    http_response: Response,
     user: user_pydantic = Depends(get_current_user),
 ):
-    product = await Product.get(id=product_id)
-    business = await product.business
-    owner = await business.owner
-
+    detail = "Not authenticated to perform this action or original price must be greater than 0."
     updated_product_info = updated_product_info.dict(exclude_unset=True)
     updated_product_info["date_published"] = datetime.now()
 
-    if user == owner and updated_product_info["original_price"] > 0:
-        updated_product_info["original_price"] = updated_product_info["original_price"]
-        updated_product_info["percentage_discount"] = (
+    if updated_product_info["original_price"] > 0:
+        updated_product_info["percentage_discount"] = int(
             (updated_product_info["original_price"] - updated_product_info["new_price"])
             / updated_product_info["original_price"]
             * 100
         )
-        product = await product.update_from_dict(updated_product_info)
-        await product.save()
+        # one conditional UPDATE; a stale If-Match ETag gets 412
+        if_match = request.headers.get("if-match")
+        try:
+            product = await update_owned_product(
+                product_id, user.id, updated_product_info, if_match, detail
+            )
+        except DoesNotExist:
+            # an offer the sweeper archived: extending it moves it back to the
+            # live catalog, other changes are made in the archive
+            expiry = updated_product_info.get("offer_expiriation_date")
+            if expiry is None or expiry < date.today():
+                product = await update_owned_product(
+                    product_id, user.id, updated_product_info, if_match, detail, ArchivedProduct
+                )
+            else:
+                product = await restore_product(
+                    product_id, user.id, updated_product_info, if_match, detail
+                )
+        await response_cache.invalidate(
+            "products", f"product:{product.id}", f"storefront:{product.business_id}"
+        )
+        if isinstance(product, Product):
+            await change_feed.publish("product.updated", product_values(product))
+        http_response.headers["ETag"] = product_etag(product)
         response = await product_pydantic.from_tortoise_orm(product)
         return {"status": "ok", "data": response}
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Not authenticated to perform this action or original price must be greater than 0.",
+        detail=detail,
         headers={"WWW-Authenticate": "Bearer"},
     )
 
 
 @app.delete("/product/{product_id}")
 async def delete_product(
-    product_id: int, user: user_pydantic = Depends(get_current_user)
+    product_id: int, request: Request, user: user_pydantic = Depends(get_current_user)
 ):
-    product = await Product.get(id=product_id)
-    business = await product.business
-    owner = await business.owner
-
-    if owner == user:
-        await product.delete()
-        return {"status": "ok", "data": "Product deleted successfully."}
-    raise HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Not authenticated to perform this action.",
-        headers={"WWW-Authenticate": "Bearer"},
+    if_match = request.headers.get("if-match")
+    try:
+        business_id = await delete_owned_product(product_id, user.id, if_match)
+    except DoesNotExist:
+        # expired offers the sweeper archived can be deleted too
+        business_id = await delete_owned_product(
+            product_id, user.id, if_match, ArchivedProduct
+        )
+    await response_cache.invalidate(
+        "products", f"product:{product_id}", f"storefront:{business_id}"
+    )
+    await change_feed.publish(
+        "product.deleted", {"id": product_id, "business_id": business_id}
     )
+    return {"status": "ok", "data": "Product deleted successfully."}
+
+
+# shutdown handlers run in registration order, so stop the background
+# tasks before Tortoise closes its connections
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await outbox_dispatcher.stop()
+    await similar_products.stop()
+    await change_feed.stop()
+    await offer_sweeper.stop()
 
 
 # Registering the Tortoise ORM models with FastAPI
 register_tortoise(
     app,
-    db_url="sqlite://db.sqlite3",
-    modules={"models": ["models"]},
-    generate_schemas=True,
+    config=tortoise_config(),
+    generate_schemas=False,  # see prepare_database
     add_exception_handlers=True,
 )
+
+
+# startup handlers that need the ORM go after register_tortoise
+@app.on_event("startup")
+async def prepare_database():
+    # the DDL only runs when the models or the extra DDL changed since it was
+    # last applied to this database
+    version = schema_version(PRICE_INDEXES, SEARCH_SCHEMA)
+    if await stored_schema_version() != version:
+        await add_missing_columns()
+        await Tortoise.generate_schemas()
+        await ensure_catalog_indexes()
+        await ensure_search_index()
+        await store_schema_version(version)
+
+
+@app.on_event("startup")
+async def build_top_deals():
+    await top_deals.build()
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    outbox_dispatcher.start()
+    change_feed.start()
+    offer_sweeper.start()
+    # built in the background; the first /similar requests wait for it
+    similar_products.start()
@@ -0,0 +1,244 @@
+"""
+Request timing, ORM query accounting and Prometheus metrics.
+
+``MetricsMiddleware`` times every request, counts the database queries it
+makes and their total time, and adds a ``Server-Timing`` header. Queries are
+counted by wrapping the ``execute_*`` methods of Tortoise's SQLite client,
+which every ORM and raw query goes through. ``render_metrics`` exports the
+totals in the Prometheus text format. Metrics are per worker process.
+"""
+
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+
+from tortoise.backends.sqlite.client import SqliteClient, TransactionWrapper
+
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = settings.SLOW_QUERY_MS
+
+# request duration histogram buckets, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+QUERY_METHODS = [
+    "execute_insert",
+    "execute_many",
+    "execute_query",
+    "execute_query_dict",
+    "execute_script",
+]
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+class RouteMetrics:
+    __slots__ = ("buckets", "count", "total", "queries", "db_time")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+# (method, route) -> RouteMetrics, (method, route, status) -> count
+routes: Dict[Tuple[str, str], RouteMetrics] = {}
+responses: Dict[Tuple[str, str, int], int] = {}
+db_totals = {"queries": 0, "seconds": 0.0, "slow": 0}
+
+# extra gauges shown on /metrics: name -> (help, callable returning {labels: value})
+collectors: Dict[str, Tuple[str, Callable[[], Dict[str, float]]]] = {}
+
+
+def record_query(sql: str, elapsed: float) -> None:
+    db_totals["queries"] += 1
+    db_totals["seconds"] += elapsed
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        db_totals["slow"] += 1
+        logger.warning("Slow query (%.1f ms): %s", elapsed * 1000, sql)
+
+
+def _timed(method):
+    @wraps(method)
+    async def timed(self, query, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(self, query, *args, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - start)
+
+    return timed
+
+
+def instrument_tortoise() -> None:
+    """
+    Wraps the SQLite client's query methods so every query is counted and timed.
+    """
+    for cls in (SqliteClient, TransactionWrapper):
+        for name in QUERY_METHODS:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "_instrumented", False):
+                timed = _timed(method)
+                timed._instrumented = True
+                setattr(cls, name, timed)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, status and database use per route.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                elapsed = (time.perf_counter() - start) * 1000
+                timing = (
+                    f'db;dur={stats.db_time * 1000:.2f};desc="{stats.queries} queries", '
+                    f"app;dur={elapsed:.2f}"
+                )
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", timing.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_stats.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            key = (scope["method"], path)
+            metrics = routes.get(key)
+            if metrics is None:
+                metrics = routes[key] = RouteMetrics()
+            metrics.buckets[bisect_left(BUCKETS, elapsed)] += 1
+            metrics.count += 1
+            metrics.total += elapsed
+            metrics.queries += stats.queries
+            metrics.db_time += stats.db_time
+            response_key = (scope["method"], path, status_code)
+            responses[response_key] = responses.get(response_key, 0) + 1
+
+
+def _labels(**labels) -> str:
+    escaped = (
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_metrics() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+    """
+    lines: List[str] = [
+        "# HELP http_request_duration_seconds Request latency by route.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for (method, path), m in sorted(routes.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ["+Inf"], m.buckets):
+            cumulative += count
+            labels = _labels(method=method, route=path, le=bound)
+            lines.append(f"http_request_duration_seconds_bucket{labels} {cumulative}")
+        labels = _labels(method=method, route=path)
+        lines.append(f"http_request_duration_seconds_sum{labels} {m.total}")
+        lines.append(f"http_request_duration_seconds_count{labels} {m.count}")
+
+    lines += [
+        "# HELP http_responses_total Responses by route and status code.",
+        "# TYPE http_responses_total counter",
+    ]
+    for (method, path, status_code), count in sorted(responses.items()):
+        labels = _labels(method=method, route=path, status=status_code)
+        lines.append(f"http_responses_total{labels} {count}")
+
+    lines += [
+        "# HELP http_request_db_queries_total Database queries made by requests, by route.",
+        "# TYPE http_request_db_queries_total counter",
+    ]
+    lines += [
+        f"http_request_db_queries_total{_labels(method=method, route=path)} {m.queries}"
+        for (method, path), m in sorted(routes.items())
+    ]
+    lines += [
+        "# HELP http_request_db_seconds_total Time requests spent in the database, by route.",
+        "# TYPE http_request_db_seconds_total counter",
+    ]
+    lines += [
+        f"http_request_db_seconds_total{_labels(method=method, route=path)} {m.db_time}"
+        for (method, path), m in sorted(routes.items())
+    ]
+
+    lines += [
+        "# HELP db_queries_total Database queries, including background tasks.",
+        "# TYPE db_queries_total counter",
+        f"db_queries_total {db_totals['queries']}",
+        "# HELP db_query_seconds_total Time spent in database queries.",
+        "# TYPE db_query_seconds_total counter",
+        f"db_query_seconds_total {db_totals['seconds']}",
+        f"# HELP db_slow_queries_total Queries slower than {SLOW_QUERY_MS:g} ms.",
+        "# TYPE db_slow_queries_total counter",
+        f"db_slow_queries_total {db_totals['slow']}",
+    ]
+
+    for name, (help_text, collect) in collectors.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for labels, value in collect().items():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def register_stats(name: str, help_text: str, stats: Callable[[], Dict[str, float]]) -> None:
+    """
+    Exports a ``stats()`` dict as a gauge labelled by stat on /metrics.
+    """
+    collectors[name] = (
+        help_text,
+        lambda: {
+            _labels(stat=stat): value
+            for stat, value in stats().items()
+            if value is not None
+        },
+    )
+
+
+def register_cache(name: str, cache) -> None:
+    """
+    Exports a cache's ``stats()`` (hits, misses, size...) on /metrics.
+    """
+    register_stats(f"cache_{name}", f"Statistics of the {name} cache.", cache.stats)
@@ -20,6 +20,7 @@ class Business(Model):
     business_description = fields.TextField(null=True)
     logo = fields.CharField(max_length=100, null=True, default="default.jpg")
     owner = fields.ForeignKeyField("models.User", related_name="businesses")
+    version = fields.IntField(default=1)  # bumped by every write, see writes.py
 
 
 class Product(Model):
@@ -35,7 +36,110 @@ class Product(Model):
         max_length=100, null=True, default="productDefault.jpg"
     )
     date_published = fields.DatetimeField(auto_now_add=True, default=datetime.now, null=True) # null means that the field is not required
-    business = fields.ForeignKeyField("models.Business", related_name="products")
+    business = fields.ForeignKeyField(
+        "models.Business", related_name="products", index=True
+    )
+    version = fields.IntField(default=1)  # bumped by every write, see writes.py
+
+    class Meta:
+        # composite indexes for the GET /product filters; the price indexes are
+        # expression indexes created in catalog.py
+        indexes = (
+            ("category", "percentage_discount"),
+            ("category", "offer_expiriation_date"),
+            ("business", "percentage_discount"),
+            ("business", "offer_expiriation_date"),
+            ("percentage_discount",),
+            ("offer_expiriation_date",),
+        )
+
+
+class ArchivedProduct(Model):
+    # expired offers moved out of "product" by the sweeper in archive.py. Ids
+    # are kept; product ids are never reused (AUTOINCREMENT) so they stay
+    # unique across both tables
+    id = fields.IntField(pk=True, generated=False)
+    name = fields.CharField(max_length=100)  # a live product may reuse the name
+    category = fields.CharField(max_length=50, index=True)
+    original_price = fields.DecimalField(max_digits=10, decimal_places=2)
+    new_price = fields.DecimalField(max_digits=10, decimal_places=2)
+    percentage_discount = fields.IntField()
+    offer_expiriation_date = fields.DateField()
+    product_description = fields.TextField(null=True)
+    product_image = fields.CharField(max_length=100, null=True)
+    date_published = fields.DatetimeField(null=True)
+    business = fields.ForeignKeyField("models.Business", related_name="archived_products")
+    version = fields.IntField(default=1)
+    archived_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "product_archive"
+        indexes = (("business", "offer_expiriation_date"),)
+
+
+class EmailOutbox(Model):
+    id = fields.IntField(pk=True, index=True)
+    recipient = fields.CharField(max_length=50)
+    subject = fields.CharField(max_length=200)
+    body = fields.TextField()
+    status = fields.CharField(max_length=10, default="pending")  # pending, sending, sent, failed
+    attempts = fields.IntField(default=0)
+    next_attempt_at = fields.DatetimeField(default=datetime.now)
+    claimed_by = fields.CharField(max_length=20, null=True)
+    last_error = fields.TextField(null=True)
+    created_at = fields.DatetimeField(auto_now_add=True)
+    sent_at = fields.DatetimeField(null=True)
+
+    class Meta:
+        table = "email_outbox"
+        indexes = (("status", "next_attempt_at"),)
+
+
+class CacheInvalidation(Model):
+    # log of response cache invalidations, read by the other workers
+    id = fields.IntField(pk=True)
+    tag = fields.CharField(max_length=100)
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "cache_invalidation"
+
+
+class ChangeEvent(Model):
+    # product and business changes streamed by GET /changes; the id is the
+    # event's sequence number
+    id = fields.IntField(pk=True)
+    kind = fields.CharField(max_length=30)
+    data = fields.TextField()  # JSON
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "change_event"
+
+
+class LazyPydantic:
+    """
+    Stands in for a ``pydantic_model_creator`` model that is only used inside
+    handlers, building it on first attribute access instead of at import.
+    Models used in route signatures must be real classes and stay eager.
+    """
+
+    def __init__(self, model, **kwargs):
+        # pin the fields the creator would see now: relations are only resolved
+        # by Tortoise.init, and building later must not add them to the schema
+        kwargs["include"] = tuple(
+            name
+            for name in model._meta.fields_map
+            if name not in model._meta.fetch_fields and name not in kwargs.get("exclude", ())
+        )
+        self._args = (model, kwargs)
+        self._model = None
+
+    def __getattr__(self, name):
+        if self._model is None:
+            model, kwargs = self._args
+            self._model = pydantic_model_creator(model, **kwargs)
+        return getattr(self._model, name)
 
 
 user_pydantic = pydantic_model_creator(User, name="User", exclude=("is_verified",))
@@ -51,21 +155,23 @@ user_pydanticOut = pydantic_model_creator(
     ),
 )
 
-business_pydantic = pydantic_model_creator(Business, name="Business")
+business_pydantic = LazyPydantic(Business, name="Business")
 business_pydanticIn = pydantic_model_creator(
-    Business, name="BusinessIn", exclude_readonly=True, exclude=("logo", "id")
+    Business, name="BusinessIn", exclude_readonly=True, exclude=("logo", "id", "version")
 )
 
 
-product_pydantic = pydantic_model_creator(
-    Product, name="Product", exclude=("business",)
-)
+product_pydantic = LazyPydantic(Product, name="Product", exclude=("business",))
 product_pydanticIn = pydantic_model_creator(
     Product,
     name="ProductIn",
     exclude_readonly=True,
-    exclude=("percentage_discount", "id", "date_published", "product_image"),
-)
-product_pydanticOut = pydantic_model_creator(
-    Product, name="ProductOut", exclude=("business",)
+    exclude=(
+        "percentage_discount",
+        "id",
+        "date_published",
+        "product_image",
+        "version",
+    ),
 )
+product_pydanticOut = LazyPydantic(Product, name="ProductOut", exclude=("business",))
@@ -0,0 +1,150 @@
+"""
+Full-text product search backed by an SQLite FTS5 index.
+
+``product_fts`` is an external-content FTS5 table over ``product``; triggers keep
+it in sync on every insert, update and delete, including bulk writes that skip
+ORM signals. Rebuild it for existing data with ``python search.py``.
+"""
+
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from tortoise import Tortoise, connections, run_async
+
+from catalog import PRODUCT_FIELDS
+from database import read_connection, tortoise_config
+from models import Product
+
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS "product_fts" USING fts5(
+    name, category, product_description, content='product', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS "product_fts_ai" AFTER INSERT ON "product" BEGIN
+    INSERT INTO product_fts(rowid, name, category, product_description)
+    VALUES (new.id, new.name, new.category, new.product_description);
+END;
+CREATE TRIGGER IF NOT EXISTS "product_fts_ad" AFTER DELETE ON "product" BEGIN
+    INSERT INTO product_fts(product_fts, rowid, name, category, product_description)
+    VALUES ('delete', old.id, old.name, old.category, old.product_description);
+END;
+CREATE TRIGGER IF NOT EXISTS "product_fts_au" AFTER UPDATE OF
+    name, category, product_description ON "product" BEGIN
+    INSERT INTO product_fts(product_fts, rowid, name, category, product_description)
+    VALUES ('delete', old.id, old.name, old.category, old.product_description);
+    INSERT INTO product_fts(rowid, name, category, product_description)
+    VALUES (new.id, new.name, new.category, new.product_description);
+END;
+"""
+
+SEARCH_QUERY = """
+SELECT id, score FROM (
+    SELECT rowid AS id, bm25(product_fts) AS score
+    FROM product_fts WHERE product_fts MATCH ?
+) {where} ORDER BY score, id LIMIT ?
+"""
+
+
+async def ensure_search_index() -> None:
+    """
+    Creates the FTS table and triggers if needed, indexing existing products
+    the first time.
+    """
+    db = connections.get("default")
+    exists = await db.execute_query_dict(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_fts'"
+    )
+    await db.execute_script(SEARCH_SCHEMA)
+    if not exists:
+        await rebuild_search_index()
+
+
+async def rebuild_search_index() -> None:
+    """
+    Re-indexes every product from the ``product`` table.
+    """
+    db = connections.get("default")
+    await db.execute_script("INSERT INTO product_fts(product_fts) VALUES ('rebuild');")
+
+
+def match_expression(q: str) -> str:
+    """
+    Turns free text into an FTS5 query: every word must match, as a prefix.
+    """
+    terms = ['"%s"*' % term.replace('"', '""') for term in q.split()]
+    return " ".join(terms)
+
+
+def encode_search_cursor(score: float, product_id: int) -> str:
+    return f"{score!r}:{product_id}"
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    """
+    Raises:
+        HTTPException: 400 when ``cursor`` is not one encode_search_cursor made.
+    """
+    try:
+        score, product_id = cursor.rsplit(":", 1)
+        score, product_id = float(score), int(product_id)
+    except ValueError:
+        score = math.nan
+    if not math.isfinite(score):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid search cursor.",
+        )
+    return score, product_id
+
+
+async def search_products(
+    q: str, limit: int, after: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Searches product names, categories and descriptions, best bm25 match first.
+
+    Args:
+        q (str): The search text.
+        limit (int): Maximum number of products to return.
+        after (str, optional): Cursor returned with the previous page.
+
+    Returns:
+        tuple: The products (``PRODUCT_FIELDS`` values) and the cursor for the
+        next page (None when there are no more results).
+    """
+    expression = match_expression(q)
+    if not expression:
+        return [], None
+    params: list = [expression]
+    where = ""
+    if after is not None:
+        score, product_id = decode_search_cursor(after)
+        where = "WHERE score > ? OR (score = ? AND id > ?)"
+        params += [score, score, product_id]
+    params.append(limit + 1)
+
+    rows = await read_connection().execute_query_dict(
+        SEARCH_QUERY.format(where=where), params
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1]["score"], rows[-1]["id"])
+
+    products = await Product.filter(id__in=[row["id"] for row in rows]).values(
+        *PRODUCT_FIELDS
+    )
+    by_id = {product["id"]: product for product in products}
+    return [by_id[row["id"]] for row in rows if row["id"] in by_id], next_cursor
+
+
+async def _rebuild() -> None:
+    await Tortoise.init(config=tortoise_config())
+    await Tortoise.generate_schemas()
+    await ensure_search_index()
+    await rebuild_search_index()
+    print("Product search index rebuilt.")
+
+
+if __name__ == "__main__":
+    run_async(_rebuild())
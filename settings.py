@@ -0,0 +1,94 @@
+"""
+Application settings, read once from ``.env`` (or the environment) when this
+module is first imported. Every other module takes its configuration from
+``settings``.
+"""
+
+from typing import Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=".env", case_sensitive=True, extra="ignore"
+    )
+
+    # JWT signing key
+    SECRET: str
+
+    # SMTP account and server; only needed once an email is sent
+    EMAIL: Optional[str] = None
+    PASSWORD: Optional[str] = None
+    MAIL_SERVER: str = "smtp.gmail.com"
+    MAIL_PORT: int = 587  # Port for STARTTLS
+    MAIL_STARTTLS: bool = True
+    MAIL_USE_CREDENTIALS: bool = True
+
+    # email outbox dispatcher
+    OUTBOX_BATCH_SIZE: int = 50
+    OUTBOX_POLL_INTERVAL: float = 5
+    OUTBOX_MAX_ATTEMPTS: int = 8
+    OUTBOX_BACKOFF: float = 30  # doubled per attempt
+    OUTBOX_MAX_BACKOFF: float = 3600
+
+    # database
+    DATABASE_URL: str = "sqlite://db.sqlite3"
+    DB_READERS: int = 4  # read-only SQLite connections, 0 disables
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE: int = -64000  # KiB when negative
+    SQLITE_BUSY_TIMEOUT: int = 5000  # ms
+
+    # authentication caches and bcrypt pool ("thread", "process" or "inline")
+    TOKEN_CACHE_SIZE: int = 10000
+    USER_CACHE_SIZE: int = 10000
+    USER_CACHE_TTL: float = 300
+    HASH_POOL: str = "thread"
+    HASH_WORKERS: int = 2
+    HASH_QUEUE_DEPTH: int = 32
+
+    # encoded response cache; "sqlite" shares invalidations between workers
+    RESPONSE_CACHE_BYTES: int = 64 * 1024 * 1024
+    RESPONSE_CACHE_BACKEND: str = "local"
+
+    # image uploads
+    MAX_UPLOAD_BYTES: int = 10 * 1024 * 1024
+    IMAGE_WORKERS: int = 2
+    IMAGE_GC_GRACE: float = 3600
+    # uploads and renditions are written here first, then moved into static/;
+    # keep it on the same filesystem so the move is an atomic rename
+    IMAGE_UPLOAD_DIR: str = "uploads"
+    # resized variants served by GET /images/...
+    IMAGE_CACHE_DIR: str = "image_cache"
+    IMAGE_CACHE_BYTES: int = 256 * 1024 * 1024
+    MAX_VARIANT_SIZE: int = 1024
+
+    # bulk import
+    IMPORT_BATCH_SIZE: int = 1000
+
+    # expired offer sweeper
+    ARCHIVE_INTERVAL: float = 3600
+    ARCHIVE_BATCH_SIZE: int = 500
+
+    # largest k served by GET /deals/top
+    DEALS_MAX_K: int = 100
+
+    # GET /product/{id}/similar: feature columns per product (4 bytes each,
+    # per product, in memory) and largest k served
+    SIMILAR_DIMENSIONS: int = 128
+    SIMILAR_MAX_K: int = 50
+
+    # GET /changes: events kept for resuming clients, events buffered per
+    # client before it is sent back to the log, seconds between polls for
+    # other workers' events and between keep-alive comments
+    FEED_BACKLOG: int = 10000
+    FEED_CLIENT_BUFFER: int = 100
+    FEED_POLL_INTERVAL: float = 1
+    FEED_HEARTBEAT: float = 15
+
+    # queries slower than this are logged
+    SLOW_QUERY_MS: float = 100
+
+
+settings = Settings()
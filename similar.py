@@ -0,0 +1,348 @@
+"""
+Similar product recommendations, served by GET /product/{id}/similar.
+
+Every product is a row of one float32 matrix: its name and description words,
+its category and its price band hashed into ``SIMILAR_DIMENSIONS`` columns
+(feature hashing, so no vocabulary is kept) and L2-normalized. The products
+most like one are then a single matrix-vector product (cosine similarity
+against the whole catalog) and an ``argpartition`` for the top k.
+
+The matrix is built at startup in the background and kept current from the
+change feed (``ChangeFeed.follow``), so products written by other workers are
+picked up as well. Each create, update or delete rewrites or moves one row.
+"""
+
+import asyncio
+import logging
+import math
+import re
+import zlib
+from datetime import date
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+
+from feed import change_feed
+from models import Product
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+SIMILAR_DIMENSIONS = settings.SIMILAR_DIMENSIONS
+SIMILAR_MAX_K = settings.SIMILAR_MAX_K
+
+# column blocks: words, category, price band (powers of two of the new price)
+CATEGORY_DIMENSIONS = 16
+PRICE_BANDS = 16
+TEXT_DIMENSIONS = SIMILAR_DIMENSIONS - CATEGORY_DIMENSIONS - PRICE_BANDS
+# weight of each block in the cosine; a name word counts twice a description
+# word
+TEXT_WEIGHT = 1.0
+CATEGORY_WEIGHT = 0.6
+PRICE_WEIGHT = 0.4
+NAME_WEIGHT = 2.0
+
+# products read (and vectorized off the event loop) per query while building
+BUILD_BATCH_SIZE = 5000
+INDEX_FIELDS = (
+    "id",
+    "name",
+    "category",
+    "product_description",
+    "new_price",
+    "offer_expiriation_date",
+)
+
+TOKEN = re.compile(r"\w\w+")
+
+# (id, name, category, description, price, expiry date)
+IndexRow = Tuple[int, str, str, Optional[str], Any, date]
+
+
+# hashed text features by word, shared by every vectorize call; cleared when
+# it reaches TOKEN_CACHE_SIZE words
+TOKEN_CACHE_SIZE = 100000
+_token_features: Dict[str, Tuple[int, float]] = {}
+
+
+def _hash(feature: str) -> int:
+    # stable across processes, unlike hash()
+    return zlib.crc32(feature.encode())
+
+
+def _token_feature(token: str) -> Tuple[int, float]:
+    if len(_token_features) >= TOKEN_CACHE_SIZE:
+        _token_features.clear()
+    h = _hash(token)
+    # signed hashing, so that collisions cancel out on average
+    feature = _token_features[token] = (h % TEXT_DIMENSIONS, 1.0 if h & 0x80000000 else -1.0)
+    return feature
+
+
+def vectorize(rows: Sequence[IndexRow]) -> np.ndarray:
+    """
+    The normalized feature vectors of ``rows``, one per row.
+    """
+    # (row * SIMILAR_DIMENSIONS + column) of every feature, summed by bincount
+    at: List[int] = []
+    values: List[float] = []
+    cached = _token_features.get
+    for i, (_, name, category, description, price, _) in enumerate(rows):
+        offset = i * SIMILAR_DIMENSIONS
+        for weight, text in ((NAME_WEIGHT, name), (1.0, description)):
+            for token in TOKEN.findall(text.lower()) if text else ():
+                column, sign = cached(token) or _token_feature(token)
+                at.append(offset + column)
+                values.append(weight * sign)
+        at.append(offset + TEXT_DIMENSIONS + _hash(category.lower()) % CATEGORY_DIMENSIONS)
+        values.append(1.0)
+        # neighbouring bands count half, so 90 and 130 are still alike
+        band = min(PRICE_BANDS - 1, int(math.log2(max(float(price), 1))))
+        offset += TEXT_DIMENSIONS + CATEGORY_DIMENSIONS
+        for shift, weight in ((-1, 0.5), (0, 1.0), (1, 0.5)):
+            if 0 <= band + shift < PRICE_BANDS:
+                at.append(offset + band + shift)
+                values.append(weight)
+    size = len(rows) * SIMILAR_DIMENSIONS
+    vectors = (
+        np.bincount(np.array(at, dtype=np.int64), values, minlength=size)
+        .astype(np.float32)
+        .reshape(len(rows), SIMILAR_DIMENSIONS)
+    )
+
+    blocks = (
+        (0, TEXT_DIMENSIONS, TEXT_WEIGHT),
+        (TEXT_DIMENSIONS, TEXT_DIMENSIONS + CATEGORY_DIMENSIONS, CATEGORY_WEIGHT),
+        (TEXT_DIMENSIONS + CATEGORY_DIMENSIONS, SIMILAR_DIMENSIONS, PRICE_WEIGHT),
+    )
+    for start, stop, weight in blocks:
+        _normalize(vectors[:, start:stop], weight)
+    _normalize(vectors, 1.0)
+    return vectors
+
+
+def _normalize(vectors: np.ndarray, length: float) -> None:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True) / length
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+
+
+def _event_row(data: Dict[str, Any]) -> IndexRow:
+    # a product.created / product.updated event body (product_values as JSON)
+    return (
+        data["id"],
+        data["name"],
+        data["category"],
+        data["product_description"],
+        Decimal(data["new_price"]),
+        date.fromisoformat(data["offer_expiriation_date"]),
+    )
+
+
+class SimilarProducts:
+    """
+    The product feature matrix and the id of the product in each row.
+
+    Rows ``[0, count)`` are in use; a deleted row is filled with the last one,
+    and the arrays double in size when full.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.matrix = np.zeros((0, SIMILAR_DIMENSIONS), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        # offer expiry dates as ordinals; expired offers are never recommended
+        self.expires = np.zeros(0, dtype=np.int32)
+        self.rows: Dict[int, int] = {}
+        self.queries = 0
+        self.updates = 0
+        self._ready: Optional[asyncio.Task] = None
+        # change events received while building, applied once it is done
+        self._pending: Optional[List[Tuple[str, Any]]] = None
+        self._tasks: set = set()
+
+    def start(self) -> None:
+        if self._ready is None:
+            self._ready = asyncio.create_task(self.build())
+
+    async def stop(self) -> None:
+        for task in (self._ready, *self._tasks):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._ready = None
+
+    async def build(self) -> None:
+        """
+        Loads every product. Changes published meanwhile are applied after.
+        """
+        self._pending = []
+        try:
+            # events from here on reach on_change, so the rows read below are
+            # at least as new as the feed position
+            await change_feed.follow(self.on_change)
+            self.clear()
+            after = 0
+            while True:
+                rows = (
+                    await Product.filter(id__gt=after)
+                    .order_by("id")
+                    .limit(BUILD_BATCH_SIZE)
+                    .values_list(*INDEX_FIELDS)
+                )
+                if not rows:
+                    break
+                await self.add_rows(rows)
+                after = rows[-1][0]
+        except Exception:
+            # the next request builds again, from scratch
+            self._pending = None
+            logger.exception("Building the similar products index failed")
+            raise
+        pending, self._pending = self._pending, None
+        for kind, data in pending:
+            self._apply(kind, data)
+
+    def clear(self) -> None:
+        self.count = 0
+        self.matrix = np.zeros((0, SIMILAR_DIMENSIONS), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.expires = np.zeros(0, dtype=np.int32)
+        self.rows = {}
+
+    async def add_rows(self, rows: Sequence[IndexRow]) -> None:
+        """
+        Adds or replaces many products, vectorized in a worker thread.
+        """
+        vectors = await asyncio.get_running_loop().run_in_executor(None, vectorize, rows)
+        self._reserve(self.count + len(rows))
+        for row, vector in zip(rows, vectors):
+            self._store(row[0], vector, row[5])
+
+    def upsert(self, row: IndexRow) -> None:
+        self._store(row[0], vectorize([row])[0], row[5])
+
+    def discard(self, product_id: int) -> None:
+        row = self.rows.pop(product_id, None)
+        if row is None:
+            return
+        self.updates += 1
+        last = self.count - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.ids[row] = self.ids[last]
+            self.expires[row] = self.expires[last]
+            self.rows[int(self.ids[row])] = row
+        self.count = last
+
+    def _reserve(self, size: int) -> None:
+        capacity = len(self.ids)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 1024)
+        matrix = np.zeros((capacity, SIMILAR_DIMENSIONS), dtype=np.float32)
+        matrix[: self.count] = self.matrix[: self.count]
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[: self.count] = self.ids[: self.count]
+        expires = np.zeros(capacity, dtype=np.int32)
+        expires[: self.count] = self.expires[: self.count]
+        self.matrix, self.ids, self.expires = matrix, ids, expires
+
+    def _store(self, product_id: int, vector: np.ndarray, expires: date) -> None:
+        self.updates += 1
+        row = self.rows.get(product_id)
+        if row is None:
+            self._reserve(self.count + 1)
+            row = self.rows[product_id] = self.count
+            self.count += 1
+        self.matrix[row] = vector
+        self.ids[row] = product_id
+        self.expires[row] = expires.toordinal()
+
+    def on_change(self, kind: str, data: Any) -> None:
+        # ChangeFeed listener
+        if self._pending is not None:
+            self._pending.append((kind, data))
+        else:
+            self._apply(kind, data)
+
+    def _apply(self, kind: str, data: Any) -> None:
+        if kind in ("product.created", "product.updated"):
+            self.upsert(_event_row(data))
+        elif kind in ("product.deleted", "product.archived"):
+            self.discard(data["id"])
+        elif kind == "products.imported":
+            # the event only names the business; read its rows not seen yet
+            task = asyncio.create_task(self._add_business(data["business_id"]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _add_business(self, business_id: int) -> None:
+        ids = await Product.filter(business_id=business_id).values_list("id", flat=True)
+        missing = [product_id for product_id in ids if product_id not in self.rows]
+        for start in range(0, len(missing), BUILD_BATCH_SIZE):
+            batch = missing[start : start + BUILD_BATCH_SIZE]
+            await self.add_rows(
+                await Product.filter(id__in=batch).values_list(*INDEX_FIELDS)
+            )
+
+    async def _vector(self, product_id: int) -> Tuple[np.ndarray, Optional[int]]:
+        row = self.rows.get(product_id)
+        if row is not None:
+            return self.matrix[row], row
+        # not indexed yet (its event is still on the way): read it
+        values = await Product.filter(id=product_id).get().values_list(*INDEX_FIELDS)
+        return vectorize([values])[0], None
+
+    async def similar(self, product_id: int, k: int) -> List[int]:
+        """
+        The ids of the ``k`` live offers most like ``product_id``, best first.
+
+        Raises:
+            DoesNotExist: If there is no product with this id.
+            HTTPException: 503 when the index could not be built.
+        """
+        if self._ready is not None:
+            ready = self._ready
+            if ready.done() and not ready.cancelled() and ready.exception() is not None:
+                ready = self._ready = asyncio.create_task(self.build())
+            try:
+                await asyncio.shield(ready)
+            except Exception:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Similar products are not available yet, please try again later.",
+                    headers={"Retry-After": "1"},
+                )
+        # products this worker just wrote are indexed before answering
+        await change_feed.flush()
+        vector, row = await self._vector(product_id)
+        self.queries += 1
+        count = self.count
+        scores = self.matrix[:count] @ vector
+        scores[self.expires[:count] < date.today().toordinal()] = -np.inf
+        if row is not None:
+            scores[row] = -np.inf
+        if k < count:
+            top = np.argpartition(scores, count - k)[count - k :]
+        else:
+            top = np.arange(count)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[np.isfinite(scores[top])]
+        return self.ids[top].tolist()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "products": self.count,
+            "bytes": self.matrix.nbytes + self.ids.nbytes + self.expires.nbytes,
+            "queries": self.queries,
+            "updates": self.updates,
+        }
+
+
+similar_products = SimilarProducts()
+
@@ -0,0 +1,172 @@
+"""
+EXPLAIN QUERY PLAN checks for the hot catalog queries: every supported
+GET /product filter combination with its facets, the storefront queries and
+the top deals queries must be answered from an index, never by scanning the
+``product`` table.
+
+    python -m pytest tests/test_query_plans.py
+"""
+
+import asyncio
+import itertools
+import os
+import shutil
+import sys
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FILTERS = {
+    "category": "tech",
+    "min_price": 10,
+    "max_price": 500,
+    "min_discount": 20,
+    "business_id": 1,
+    "active": True,
+}
+FILTER_SETS = [
+    names
+    for n in range(1, len(FILTERS) + 1)
+    for names in itertools.combinations(FILTERS, n)
+]
+
+# seeded catalog
+BUSINESSES = 20
+PRODUCTS = 2000
+CATEGORIES = ["tech", "home", "garden", "sports", "books", "toys", "food", "fashion"]
+
+
+@pytest.fixture(scope="module")
+def run(tmp_path_factory):
+    """
+    Starts the app in a throwaway directory with a seeded database and
+    yields a function running a coroutine on its event loop.
+    """
+    workdir = tmp_path_factory.mktemp("query-plans")
+    for name in ("static", "templates"):
+        shutil.copytree(os.path.join(ROOT, name), workdir / name)
+    (workdir / ".env").write_text("SECRET=test\nEMAIL=test@example.com\nPASSWORD=test\n")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    import archive
+    import emails
+    import main
+
+    # nothing is sent, and the seeded expired offers stay in the hot table
+    emails.outbox_dispatcher.start = lambda: None
+    archive.offer_sweeper.start = lambda: None
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main.app.router.startup())
+        try:
+            loop.run_until_complete(seed())
+            yield loop.run_until_complete
+        finally:
+            loop.run_until_complete(main.app.router.shutdown())
+    finally:
+        loop.close()
+        os.chdir(cwd)
+
+
+async def seed():
+    from models import Business, Product, User
+
+    await User.bulk_create(
+        [
+            User(username=f"owner{i}", email=f"owner{i}@example.com", password="x")
+            for i in range(BUSINESSES)
+        ]
+    )
+    owners = await User.all().order_by("id")
+    await Business.bulk_create(
+        [Business(business_name=f"business{i}", owner=owner) for i, owner in enumerate(owners)]
+    )
+    businesses = await Business.all().order_by("id")
+    today = date.today()
+    products = []
+    for i in range(PRODUCTS):
+        original_price = Decimal(5 + i % 997)
+        discount = i % 90
+        products.append(
+            Product(
+                name=f"product{i}",
+                category=CATEGORIES[i % len(CATEGORIES)],
+                original_price=original_price,
+                new_price=original_price * (100 - discount) / 100,
+                percentage_discount=discount,
+                offer_expiriation_date=today + timedelta(days=i % 120 - 30),
+                business=businesses[i % BUSINESSES],
+            )
+        )
+    await Product.bulk_create(products, batch_size=500)
+
+
+async def query_plan(query, params=None):
+    from tortoise import connections
+
+    if not isinstance(query, str):
+        query = query.sql(params_inline=True)
+    rows = await connections.get("default").execute_query_dict(
+        "EXPLAIN QUERY PLAN " + query, params
+    )
+    return [row["detail"] for row in rows]
+
+
+def full_scans(plan, ordered_walk=False):
+    # "SCAN product" walks the table; "SCAN product USING [COVERING] INDEX" walks
+    # a whole index, which is no better, unless the query reads the index in its
+    # own order and stops at a LIMIT (ordered_walk)
+    if ordered_walk:
+        return [step for step in plan if step == "SCAN product"]
+    return [step for step in plan if step.startswith("SCAN product")]
+
+
+@pytest.mark.parametrize("names", FILTER_SETS, ids=",".join)
+def test_product_listing_uses_indexes(run, names):
+    from catalog import ProductFilters, facet_querysets, filter_products, page_queryset
+    from models import Product
+
+    filters = ProductFilters(**{name: FILTERS[name] for name in names})
+    queryset, key = filter_products(Product.all(), filters)
+    categories, prices = facet_querysets(queryset)
+    queries = {
+        "first page": page_queryset(queryset, 51, None, key),
+        "next page": page_queryset(queryset, 51, 1000, key),
+        "category facet": categories,
+        "price facet": prices,
+    }
+    scans = {label: full_scans(run(query_plan(query))) for label, query in queries.items()}
+    assert not any(scans.values()), scans
+
+
+@pytest.mark.parametrize(
+    "label",
+    [
+        "storefront page",
+        "storefront summary",
+        "storefront categories",
+        "top deals",
+        "top deals by category",
+    ],
+)
+def test_storefront_and_deals_use_indexes(run, label):
+    from catalog import STOREFRONT_CATEGORIES_SQL, STOREFRONT_SUMMARY_SQL, page_queryset
+    from deals import DealBoard
+    from models import Product
+
+    query = {
+        "storefront page": lambda: page_queryset(Product.filter(business_id=1), 51, 1000),
+        "storefront summary": lambda: STOREFRONT_SUMMARY_SQL,
+        "storefront categories": lambda: STOREFRONT_CATEGORIES_SQL,
+        "top deals": lambda: DealBoard(None).queryset(date.today()),
+        "top deals by category": lambda: DealBoard("tech").queryset(date.today()),
+    }[label]()
+    plan = run(query_plan(query, [1] if isinstance(query, str) else None))
+    # the top deals board reads the discount index in order up to its size
+    assert not full_scans(plan, ordered_walk=label == "top deals"), plan
@@ -0,0 +1,238 @@
+"""
+Conditional single-statement writes for products and businesses.
+
+Each write is one ``UPDATE`` or ``DELETE`` whose ``WHERE`` clause carries the
+ownership check and, when the client sent ``If-Match``, the row versions from
+the ETag it holds. The row is only loaded again when nothing matched, to tell
+a missing row (404) from someone else's (401) or a stale ETag (412).
+``RETURNING`` needs SQLite 3.35 or newer.
+
+The product writes also take ``model=ArchivedProduct``, for offers the sweeper
+in archive.py moved out of ``product``.
+"""
+
+from typing import Any, Dict, List, NoReturn, Optional, Tuple, Type, Union
+
+from fastapi import HTTPException, status
+from tortoise import connections
+from tortoise.exceptions import DoesNotExist
+
+from catalog import business_etag, product_etag
+from models import ArchivedProduct, Business, Product
+
+NOT_OWNER = "Not authenticated to perform this action."
+
+# the product ETag covers its business too (see product_etag); "{table}" is
+# "product" or "product_archive"
+BUSINESS_VERSION_SQL = '(SELECT "version" FROM "business" WHERE "id" = "{table}"."business_id")'
+# correlated on the business primary key; "business_id IN (SELECT id FROM
+# business WHERE owner_id = ?)" would scan business (owner_id has no index)
+OWNED_BY_SQL = '(SELECT "owner_id" FROM "business" WHERE "id" = "{table}"."business_id") = ?'
+
+ProductModel = Union[Type[Product], Type[ArchivedProduct]]
+
+
+def parse_if_match(if_match: Optional[str]) -> Optional[List[Tuple[int, ...]]]:
+    """
+    Reads the row versions out of an ``If-Match`` header.
+
+    Returns:
+        None when the write is unconditional (no header or ``*``), otherwise
+        the versions of every tag in the header. Weak and unknown tags never
+        match, so they are left out.
+    """
+    if if_match is None or if_match.strip() == "*":
+        return None
+    versions = []
+    for tag in if_match.split(","):
+        tag = tag.strip()
+        if len(tag) < 2 or not (tag[0] == tag[-1] == '"'):
+            continue
+        try:
+            versions.append(tuple(int(part) for part in tag[1:-1].split(".")))
+        except ValueError:
+            continue
+    return versions
+
+
+def _version_clause(columns: List[str], versions: Optional[List[Tuple[int, ...]]]):
+    # "AND ((a = ? AND b = ?) OR ...)" for the tags that fit these columns
+    if versions is None:
+        return "", []
+    versions = [v for v in versions if len(v) == len(columns)]
+    if not versions:
+        return " AND 0", []
+    match = " AND ".join(f"{column} = ?" for column in columns)
+    clause = " OR ".join(f"({match})" for _ in versions)
+    return f" AND ({clause})", [value for v in versions for value in v]
+
+
+def columns(model) -> str:
+    # read at call time: foreign key columns only exist after Tortoise.init
+    return ", ".join(f'"{c}"' for c in model._meta.fields_db_projection.values())
+
+
+def _assignments(model, values: Dict[str, Any]):
+    db = connections.get("default")
+    column_map = db.executor_class(model=model, db=db).column_map
+    projection = model._meta.fields_db_projection
+    sql = [f'"{projection[name]}" = ?' for name in values]
+    params = [column_map[name](value, None) for name, value in values.items()]
+    return ", ".join(sql + ['"version" = "version" + 1']), params
+
+
+def _precondition_failed(etag: str) -> NoReturn:
+    raise HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail="The resource was changed since it was read.",
+        headers={"ETag": etag},
+    )
+
+
+def _not_owner(detail: str) -> NoReturn:
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def product_conditions(
+    model: ProductModel, if_match: Optional[str]
+) -> Tuple[str, str, List[Any]]:
+    """
+    The business version column, and the ownership and ``If-Match`` SQL
+    (with its parameters after the owner id) for writes to ``model``'s table.
+    """
+    table = model._meta.db_table
+    business_version = BUSINESS_VERSION_SQL.format(table=table)
+    condition, versions = _version_clause(
+        ['"version"', business_version], parse_if_match(if_match)
+    )
+    return business_version, OWNED_BY_SQL.format(table=table) + condition, versions
+
+
+async def product_write_refused(
+    product_id: int, owner_id: int, detail: str, model: ProductModel = Product
+) -> NoReturn:
+    """
+    Explains why a conditional product write matched nothing.
+
+    Raises:
+        DoesNotExist: If there is no product with this id.
+        HTTPException: 401 for products of other owners, 412 otherwise.
+    """
+    product = (
+        await model.filter(id=product_id)
+        .select_related("business")
+        .using_db(connections.get("default"))
+        .first()
+    )
+    if product is None:
+        # the same 404 whichever table was written
+        raise DoesNotExist(Product)
+    if product.business.owner_id != owner_id:
+        _not_owner(detail)
+    _precondition_failed(product_etag(product))
+
+
+async def update_owned_product(
+    product_id: int,
+    owner_id: int,
+    values: Dict[str, Any],
+    if_match: Optional[str] = None,
+    detail: str = NOT_OWNER,
+    model: ProductModel = Product,
+) -> Product:
+    """
+    Writes ``values`` to a product of ``owner_id`` and bumps its version in
+    one statement.
+
+    Raises:
+        DoesNotExist: If there is no product with this id.
+        HTTPException: 401 for products of other owners, 412 with the current
+            ETag when ``if_match`` does not match it.
+
+    Returns:
+        Product: The updated row with ``business`` loaded, ready for
+        ``product_etag``.
+    """
+    assignments, params = _assignments(model, values)
+    business_version, condition, versions = product_conditions(model, if_match)
+    db = connections.get("default")
+    _, rows = await db.execute_query(
+        f'UPDATE "{model._meta.db_table}" SET {assignments} WHERE "id" = ? AND {condition} '
+        f'RETURNING {columns(model)}, {business_version} AS "business_version"',
+        [*params, product_id, owner_id, *versions],
+    )
+    if not rows:
+        await product_write_refused(product_id, owner_id, detail, model)
+    row = dict(rows[0])
+    business_version = row.pop("business_version")
+    product = model._init_from_db(**row)
+    # only the version is read from the business; the id and owner are implied
+    product.business = Business._init_from_db(
+        id=product.business_id, owner_id=owner_id, version=business_version
+    )
+    return product
+
+
+async def delete_owned_product(
+    product_id: int,
+    owner_id: int,
+    if_match: Optional[str] = None,
+    model: ProductModel = Product,
+) -> int:
+    """
+    Deletes a product of ``owner_id`` in one statement.
+
+    Raises:
+        DoesNotExist: If there is no product with this id.
+        HTTPException: 401 for products of other owners, 412 with the current
+            ETag when ``if_match`` does not match it.
+
+    Returns:
+        int: The id of the business the product belonged to.
+    """
+    _, condition, versions = product_conditions(model, if_match)
+    db = connections.get("default")
+    _, rows = await db.execute_query(
+        f'DELETE FROM "{model._meta.db_table}" WHERE "id" = ? AND {condition} '
+        'RETURNING "business_id"',
+        [product_id, owner_id, *versions],
+    )
+    if not rows:
+        await product_write_refused(product_id, owner_id, NOT_OWNER, model)
+    return rows[0]["business_id"]
+
+
+async def update_owned_business(
+    business_id: int,
+    owner_id: int,
+    values: Dict[str, Any],
+    if_match: Optional[str] = None,
+) -> Business:
+    """
+    Writes ``values`` to a business of ``owner_id`` and bumps its version in
+    one statement.
+
+    Raises:
+        DoesNotExist: If there is no business with this id.
+        HTTPException: 401 for businesses of other owners, 412 with the
+            current ETag when ``if_match`` does not match it.
+    """
+    assignments, params = _assignments(Business, values)
+    condition, versions = _version_clause(['"version"'], parse_if_match(if_match))
+    db = connections.get("default")
+    _, rows = await db.execute_query(
+        f'UPDATE "business" SET {assignments} WHERE "id" = ? AND "owner_id" = ?{condition} '
+        f"RETURNING {columns(Business)}",
+        [*params, business_id, owner_id, *versions],
+    )
+    if rows:
+        return Business._init_from_db(**dict(rows[0]))
+
+    business = await Business.filter(id=business_id).using_db(db).get()
+    if business.owner_id != owner_id:
+        _not_owner(NOT_OWNER)
+    _precondition_failed(business_etag(business))